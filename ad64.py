@@ -5,13 +5,25 @@ from asm import asm
 from d64 import Disk
 
 disk = 'test.d64'
-fn = sys.argv[1]
-r = asm(fn)
-if r :
-    base,bs = r
-    bs = ''.join(chr(b) for b in bs)
-    d = Disk('asm.d64')
-    d.removeFile("ASM")
-    d.writeFile("ASM", base, bs)
-    d.sync()
 
+def assemble(fn, stats=None) :
+    """
+    Assemble fn through the incremental cache.  Zero page relaxation is
+    off: it depends on symbol values, so it would rerun pass 1 over the
+    whole file on every edit.
+    """
+    return asm(fn, cache=True, zpg=False, stats=stats)
+
+def main() :
+    fn = sys.argv[1]
+    r = assemble(fn)
+    if r :
+        base,bs = r
+        bs = ''.join(chr(b) for b in bs)
+        d = Disk('asm.d64')
+        d.removeFile("ASM")
+        d.writeFile("ASM", base, bs)
+        d.sync()
+
+if __name__ == '__main__' :
+    main()
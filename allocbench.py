@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Compare d64 sector allocation policies by the estimated time a drive
+spends seeking and waiting for sectors while loading each file.
+
+Cost model: the disk turns at 300rpm, a track of n sectors passes
+a sector every 200/n ms, and the head takes stepMs per track to move.
+After reading a sector the loader is busy for busyMs before it asks
+for the next one; whatever part of the revolution has gone by then
+is lost waiting for the sector to come round.
+"""
+import os, sys, random, tempfile
+import d64
+
+revMs = 200.0
+stepMs = 12.0
+
+def chainCost(d, loc, busyMs) :
+    """Return (tracks stepped, rotational wait ms, total ms) to load the chain at loc."""
+    steps = 0
+    wait = 0.0
+    now = 0.0
+    cur = d.fmt.dirTrack  # the directory was just read
+    for t,s,dat in d.fileSectors(loc) :
+        if t != cur :
+            steps += abs(t - cur)
+            now += stepMs * abs(t - cur)
+            cur = t
+        n = d.fmt.spt[t]
+        angle = (now % revMs) / revMs
+        w = ((float(s) / n - angle) % 1.0) * revMs
+        wait += w
+        now += w + revMs / n + busyMs
+    return steps, wait, now
+
+def fill(fn, alloc, sizes) :
+    d64.newImage(fn, 'BENCH')
+    d = d64.Disk(fn, alloc=alloc)
+    for n,sz in enumerate(sizes) :
+        d.writeFile('F%d' % n, 0x0801, '\xea' * sz)
+    d.sync()
+    return d
+
+def bench(sizes, busyMs) :
+    policies = [
+        ('first-free', FirstFree()),
+        ('dos', d64.DosAlloc()),
+        ('fast', d64.FastAlloc()),
+    ]
+    fd,fn = tempfile.mkstemp(suffix='.d64')
+    os.close(fd)
+    try :
+        print 'busy %.1fms per sector, %d files' % (busyMs, len(sizes))
+        print '%-12s %8s %10s %10s %10s' % ('policy', 'steps', 'wait ms', 'ms/file', 'ms/block')
+        for name,alloc in policies :
+            d = fill(fn, alloc, sizes)
+            steps, wait, total, blocks = 0, 0.0, 0.0, 0
+            for n in xrange(len(sizes)) :
+                e = d.lookup('F%d' % n)
+                st,w,tot = chainCost(d, e.loc, busyMs)
+                steps += st
+                wait += w
+                total += tot
+                blocks += e.size
+            d.close()
+            print '%-12s %8d %10.1f %10.1f %10.2f' % (name, steps, wait, total / len(sizes), total / blocks)
+    finally :
+        os.remove(fn)
+
+class FirstFree(d64.DosAlloc) :
+    """The old allocator: lowest free sector on the lowest track with room."""
+    def first(self, bam) :
+        for t in xrange(1, bam.fmt.tracks+1) :
+            if t != bam.fmt.dirTrack and bam.trackFree(t) :
+                return t, bam.firstFree(t)
+        raise d64.Error("disk full")
+    def next(self, bam, t, s) :
+        return self.first(bam)
+
+def main() :
+    random.seed(64)
+    nfiles = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    sizes = [random.randint(200, 8000) for n in xrange(nfiles)]
+    # roughly the stock kernal loader, then a fast loader
+    for busyMs in (80.0, 15.0) :
+        bench(sizes, busyMs)
+        print
+
+if __name__ == '__main__' :
+    main()
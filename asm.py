@@ -1,8 +1,17 @@
 #!/usr/bin/env python
 """
 mini 6502 assembler in python
+
+    asm.py [-l | -c] [-O] file.s...
+
+With -l prints a listing with each instruction's cycles (a range where
+page crossing or a branch being taken costs more), the straight line
+totals from each label to the next and the cycles for one time round
+each loop.  With -O the program goes through the peephole optimiser in
+peep.py before it is assembled.  With -c each file is assembled to a
+relocatable object file.o for ld64.py to link.
 """
-import sys
+import os, sys, re, getopt, hashlib, marshal
 
 class SyntaxError(Exception) :
     pass
@@ -13,88 +22,100 @@ if 0 :
     SyntaxError = None
     AsmError = None
 
-class Buf(object) :
-    def __init__(self, s) :
-        self.buf = s
+# One regex tokenises a whole source file.  Comments and blanks are
+# dropped, a missing final newline is supplied, and anything else that
+# doesn't make a token is a "bad" token for the parser to complain about.
+tokenRe = re.compile(r"""
+      (?P<space> [ \t]+ | ;[^\n]* )
+    | (?P<hex> \$[ \t]*[0-9a-fA-F]+ )
+    | (?P<dec> [0-9]+ )
+    | (?P<name> [A-Za-z_][A-Za-z0-9_]* )
+    | (?P<eol> \n )
+    | (?P<punct> [#(),=*] )
+    | (?P<bad> . )
+""", re.X)
+
+def tokenize(src) :
+    """Return a list of lines, each a list of (kind, value, column) ending with an 'eol' token."""
+    lines = []
+    toks = []
+    sol = 0
+    for m in tokenRe.finditer(src) :
+        kind = m.lastgroup
+        if kind == 'space' :
+            continue
+        col = m.start() - sol
+        text = m.group()
+        if kind == 'eol' :
+            toks.append(('eol', text, col))
+            lines.append(toks)
+            toks = []
+            sol = m.end()
+        elif kind == 'hex' :
+            toks.append(('int', int(text[1:].lstrip(' \t'), 16), col))
+        elif kind == 'dec' :
+            toks.append(('int', int(text), col))
+        elif kind == 'punct' :
+            toks.append((text, text, col))
+        else :
+            toks.append((kind, text, col))
+    if toks :
+        toks.append(('eol', '\n', len(src) - sol))
+        lines.append(toks)
+    return lines
+
+class Tokens(object) :
+    """Cursor over the tokens of one line."""
+    def __init__(self, toks) :
+        self.toks = toks
         self.pos = 0
     def peek(self) :
-        if self.pos < len(self.buf) :
-            return self.buf[self.pos]
+        return self.toks[self.pos]
     def next(self) :
-        ch = self.peek()
-        if ch is not None :
+        t = self.toks[self.pos]
+        if t[0] != 'eol' :
+            self.pos += 1
+        return t
+    def accept(self, kind) :
+        t = self.toks[self.pos]
+        if t[0] == kind :
             self.pos += 1
-        return ch
-    def skipSpaces(self) :
-        while self.peek() in [' ', '\t'] :
-            self.next()
-    def advance(self, n) :
-        self.pos += n
-        if self.pos > len(self.buf) :
-            self.pos = len(self.buf)
-    def match(self, s) :
-        # XXX case-insensitive matching
-        if self.buf[self.pos:].startswith(s) :
-            self.advance(len(s))
-            return True
+            return t
+    def col(self) :
+        return self.toks[self.pos][2]
 
 class Val(object) :
     def __init__(self, typ, **kw) :
         self.keys = kw.keys()
         self.typ = typ
-        for k,v in kw.items() :
-            setattr(self, k, v)
+        self.__dict__.update(kw)
     def __repr__(self) :
         return '[Val %s %s]' % (self.typ, ' '.join('%s=%s' % (k, getattr(self, k)) for k in self.keys))
     def __str__(self) :
         return self.__repr__()
 
-def hexVal(ch) :
-    return "0123456789ABCDEF".index(ch.upper())
-
-def parseInt(b) :
-    n = 0
-    if b.match('$') :
-        b.skipSpaces()
-        start = b.pos
-        while b.peek() in "0123456789abcdefABCDEF" :
-            n = n * 16 + hexVal(b.next())
-    else :
-        start = b.pos
-        while b.peek() in "0123456789" :
-            n = n * 10 + hexVal(b.next())
-    if b.pos > start :
-        return Val("int", val=n)
-
-def parseVar(b) :
-    if b.peek() and b.peek().isalpha() :
-        s = ''
-        while b.peek() and (b.peek().isalpha() or b.peek().isdigit() or b.peek() in "_") :
-            s += b.next()
-        return Val("var", name=s)
-
 def parseNum(b) :
     """Int or Var"""
-    v = parseInt(b)
-    if v is None :
-        v = parseVar(b)
-    return v
+    kind,val,col = b.peek()
+    if kind == 'int' :
+        b.next()
+        return Val("int", val=val)
+    if kind == 'name' :
+        b.next()
+        return Val("var", name=val)
 
-def parseImm(b) :
-    b.skipSpaces()
-    if b.match('#') :
-        b.skipSpaces()
-        n = parseNum(b)
+def parseIndex(b) :
+    """The register name after a comma, lower cased."""
+    t = b.accept('name')
+    if t is None or t[1].lower() not in ("x", "y") :
+        raise SyntaxError("bad index")
+    return t[1].lower()
 
 opcodes = "adc and asl bcc bcs beq bit bmi bne bpl brk bvc bvs clc cld cli clv cmp cpx cpy dec dex dey eor inc inx iny jmp jsr lda ldx ldy lsr nop ora pha php pla plp rol ror rti rts sbc sec sed sei sta stx sty tax tay tsx txa txs tya".split(' ')
-
-def parseOp(b) :
-    for op in opcodes :
-        if b.match(op) :
-            return op
+mnemonics = set(opcodes)
 
 def expect(b, s) :
-    if b.match(s) is None :
+    if b.accept(s) is None :
         raise SyntaxError("expected %r" % s)
 
 def require(x, msg) :
@@ -116,52 +137,40 @@ def require(x, msg) :
 # ind       - (num)
 # ind,Y     - (num),Y
 def parseOpArg(b) :
-    b.skipSpaces()
     num = parseNum(b)
     if num is not None and num.typ == 'var' and num.name.lower() == 'a' :
         v = Val("A")
     elif num is not None :
-        b.skipSpaces()
-        if b.match(",") :
-            var = parseVar(b)
-            if var is None or var.name.lower() not in ("x", "y") :
-                raise SyntaxError("bad index")
-            if var.name.lower() == "x" :
+        if b.accept(",") :
+            if parseIndex(b) == "x" :
                 v = Val("abs,X", val=num)
             else :
                 v = Val("abs,Y", val=num)
         else :
             v = Val("abs", val=num)
-    elif b.match("#") :
-        b.skipSpaces()
+    elif b.accept("#") :
         n = parseNum(b)
         if n is None :
             raise SyntaxError("bad immediate")
         v = Val("#", val=n)
-    elif b.match("(") :
-        b.skipSpaces()
+    elif b.accept("(") :
         num = parseNum(b)
         if num is None :
             raise SyntaxError("missing indirect address")
-        b.skipSpaces()
-        if b.match(",") :
-            b.skipSpaces()
-            var2 = parseVar(b)
-            if var2 is None or var2.name.lower != "x" :
+        if b.accept(",") :
+            if parseIndex(b) != "x" :
                 raise SyntaxError("bad index")
-            b.skipSpaces()
             expect(b, ")")
             v = Val("X,ind", val=num)
-        elif b.match(")") :
-            b.skipSpaces()
-            if b.match(",") :
-                b.skipSpaces()
-                var2 = parseVar(b)
-                if var2 is None or var2.name.lower() != "y" :
+        elif b.accept(")") :
+            if b.accept(",") :
+                if parseIndex(b) != "y" :
                     raise SyntaxError("bad index")
                 v = Val("ind,Y", val=num)
             else :
                 v = Val("ind", val=num)
+        else :
+            raise SyntaxError("expected ')'")
     else :
         v = Val("impl")
     return v
@@ -246,61 +255,59 @@ def checkArgType(op, arg) :
     raise SyntaxError("bad argument type %r for opcode %r" % (arg.typ, op))
 
 def parseLine(b) :
-    b.skipSpaces()
-    op = parseOp(b)
-    if op is None :
-        var = parseVar(b)
-
-    if op is not None :
-        b.skipSpaces()
+    kind,val,col = b.peek()
+    if kind == 'name' and val.lower() in mnemonics :
+        b.next()
+        op = val.lower()
         arg = parseOpArg(b) # optional
         arg.typ = checkArgType(op, arg)
         v = Val("op", op=op, arg=arg)
-    elif var is not None :
-        b.skipSpaces()
+    elif kind == 'name' :
+        b.next()
         expect(b, "=")
-        b.skipSpaces()
         expect(b, "*")
-        v = Val("setvar", var=var.name)
-    elif b.match("*") :
-        b.skipSpaces()
+        v = Val("setvar", var=val)
+    elif b.accept("*") :
         expect(b, "=")
-        b.skipSpaces()
         num = parseNum(b)
         require(num, "missing value")
         v =  Val("setdot", val=num)
-    elif b.peek() == '\n' :
+    elif kind == 'eol' :
         v = Val(None) # blank line
     else :
         raise SyntaxError("unexpected")
 
-    b.skipSpaces()
-    if not b.match("\n") :
-        raise SyntaxError("expected EOL, got %r" % b.peek())
+    if not b.accept("eol") :
+        raise SyntaxError("expected EOL, got %r" % b.peek()[1])
     return v
 
-def stripComments(l) :
-    if ';' in l :
-        l = l.split(';',1)[0] + '\n'
-    return l
+def reportSyntax(line, lno, b, e) :
+    print line.rstrip('\n')
+    spaces = ' ' * b.col()
+    print '%s^  line %d pos %d: %s' % (spaces, lno, b.col(), e)
 
-def parseFile(fn) :
-    f = file(fn)
-    lno = 0
+def parseSource(src) :
+    """Parse source text into a list of Vals, one per line, or None after reporting a syntax error."""
     prog = []
-    try :
-        for l in f :
-            l = stripComments(l)
+    for lno,toks in enumerate(tokenize(src), 1) :
+        b = Tokens(toks)
+        try :
+            prog.append(parseLine(b))
+        except SyntaxError, e :
+            reportSyntax(src.split('\n')[lno-1], lno, b, e)
+            return None
+    return prog
 
-            lno += 1
-            b = Buf(l)
-            v = parseLine(b)
-            prog.append(v)
-        return prog
+def parseOne(line, lno) :
+    """Parse a single source line, or return None after reporting a syntax error."""
+    b = Tokens(tokenize(line)[0])
+    try :
+        return parseLine(b)
     except SyntaxError, e :
-        print b.buf.replace('\n', '')
-        spaces = ' ' * b.pos
-        print '%s^  line %d pos %d: %s' % (spaces, lno, b.pos, e)
+        reportSyntax(line, lno, b, e)
+
+def parseFile(fn) :
+    return parseSource(file(fn).read())
 
 # (opname,addrmode) => (opcode, size)
 opTab = {
@@ -365,7 +372,7 @@ opTab = {
     ('pla','impl'): (104,1),
     ('adc','#'): (105,2),
     ('ror','A'): (106,1),
-    ('jmp','ind'): (108,2),
+    ('jmp','ind'): (108,3),
     ('adc','abs'): (109,3),
     ('ror','abs'): (110,3),
     ('bvs','rel'): (112,2),
@@ -457,6 +464,34 @@ opTab = {
     ('inc','abs,X'): (254,3),
 }
 
+# Base cycle counts.  Reads through abs,X / abs,Y / (ind),Y take one more
+# when the indexing crosses a page, and taken branches one more (two if
+# to another page).
+readCycles = {'#': 2, 'zpg': 3, 'zpg,X': 4, 'zpg,Y': 4, 'abs': 4, 'abs,X': 4, 'abs,Y': 4, 'X,ind': 6, 'ind,Y': 5}
+storeCycles = {'zpg': 3, 'zpg,X': 4, 'zpg,Y': 4, 'abs': 4, 'abs,X': 5, 'abs,Y': 5, 'X,ind': 6, 'ind,Y': 6}
+rmwCycles = {'A': 2, 'zpg': 5, 'zpg,X': 6, 'abs': 6, 'abs,X': 7}
+otherCycles = {
+    ('brk','impl'): 7, ('rti','impl'): 6, ('rts','impl'): 6, ('jsr','abs'): 6,
+    ('jmp','abs'): 3, ('jmp','ind'): 5,
+    ('pha','impl'): 3, ('php','impl'): 3, ('pla','impl'): 4, ('plp','impl'): 4,
+}
+
+cycles = {}
+pageCross = set()
+for op,mode in opTab :
+    if (op,mode) in otherCycles :
+        cycles[op,mode] = otherCycles[op,mode]
+    elif mode in ('impl', 'rel') :
+        cycles[op,mode] = 2
+    elif op in ('sta', 'stx', 'sty') :
+        cycles[op,mode] = storeCycles[mode]
+    elif op in ('asl', 'lsr', 'rol', 'ror', 'inc', 'dec') :
+        cycles[op,mode] = rmwCycles[mode]
+    else :
+        cycles[op,mode] = readCycles[mode]
+        if mode in ('abs,X', 'abs,Y', 'ind,Y') :
+            pageCross.add((op,mode))
+
 def getVar(vars, nm, req) :
     if not req :
         return 0
@@ -479,21 +514,22 @@ def encSigned8(n) :
         return 256 + n
     return n
 
-def evalOpArg(vars, a, reqVar) :
-    if a.typ in ['A', 'impl'] :
+def evalOpArg(vars, a, reqVar, typ=None) :
+    typ = typ or a.typ
+    if typ in ['A', 'impl'] :
         return []
-    elif a.typ in  ['#', 'zpg', 'zpg,X', 'zpg,Y', "ind,X", "ind,Y"] :
+    elif typ in  ['#', 'zpg', 'zpg,X', 'zpg,Y', "X,ind", "ind,Y"] :
         n = evalNum(vars, a.val, reqVar)
         if n > 255 :
             raise AsmError("byte value too big: %x" % n)
         return [n]
-    elif a.typ in ['#', 'abs', 'abs,X', 'abs,Y', 'ind'] :
+    elif typ in ['#', 'abs', 'abs,X', 'abs,Y', 'ind'] :
         #print a
         n = evalNum(vars, a.val, reqVar)
         if n > 65535 :
             raise AsmError("addr value too big: %x" % n)
         return [n & 0xff, n >> 8]
-    elif a.typ == 'rel' :
+    elif typ == 'rel' :
         n = 0
         if reqVar :
             v = evalNum(vars, a.val, reqVar)
@@ -504,7 +540,8 @@ def evalOpArg(vars, a, reqVar) :
         print a.typ
         assert 0
 
-def execLine(vars, l, reqVar) :
+def execLine(vars, l, reqVar, mode=None) :
+    """Run one line, returning its bytes.  mode overrides the parsed addressing mode."""
     if l.typ == 'setdot' :
         #print l
         vars['*'] = evalNum(vars, l.val, reqVar)
@@ -514,9 +551,9 @@ def execLine(vars, l, reqVar) :
         vars[l.var] = vars['*']
         bs = []
     elif l.typ == 'op' :
-        k = l.op, l.arg.typ
+        k = l.op, mode or l.arg.typ
         opnum,sz = opTab[k]
-        bs = evalOpArg(vars, l.arg, reqVar)
+        bs = evalOpArg(vars, l.arg, reqVar, k[1])
         bs = [opnum] + bs
         #print opnum, bs, sz, k
         assert sz == len(bs)
@@ -527,19 +564,88 @@ def execLine(vars, l, reqVar) :
     vars['*'] += len(bs)
     return bs
 
-def asmPass(vars, prog, reqVar) :
+zpgForm = {'abs': 'zpg', 'abs,X': 'zpg,X', 'abs,Y': 'zpg,Y'}
+absForm = dict((z, a) for a,z in zpgForm.items())
+maxRelax = 50
+
+def peekNum(vars, num) :
+    """An operand's value from the symbols so far, or None if it isn't known yet."""
+    if num.typ == 'int' :
+        return num.val
+    return vars.get(num.name)
+
+def layout(prog, modes, syms) :
+    """Lay out the program with the given modes.  Returns the symbol table."""
+    vars = {}
+    dot = 0
+    for l,mode in zip(prog, modes) :
+        if l.typ == 'op' :
+            dot += opTab[l.op, mode][1]
+        elif l.typ == 'setvar' :
+            vars[l.var] = dot
+        elif l.typ == 'setdot' :
+            dot = peekNum(syms, l.val) or 0
+    return vars
+
+def relax(prog) :
+    """
+    Pick zero page addressing for every operand that fits.  All the
+    candidates start out in zero page and the program is laid out over
+    and over, widening to absolute any whose operand turns out not to
+    fit (or isn't defined), until neither the modes nor the symbols
+    change.  A forward reference only gets its value from a layout, and
+    widening one operand can push a later label out of zero page, which
+    is why this goes round until it settles.  Since operands only ever
+    widen it settles quickly.  Returns the modes and the symbol table.
+    """
+    modes = [l.arg.typ if l.typ == 'op' else None for l in prog]
+    cands = []
+    for i,l in enumerate(prog) :
+        if l.typ == 'op' and l.arg.typ in zpgForm and (l.op, zpgForm[l.arg.typ]) in opTab :
+            modes[i] = zpgForm[l.arg.typ]
+            cands.append(i)
+    vars = {}
+    for n in xrange(maxRelax) :
+        prev = vars
+        vars = layout(prog, modes, prev)
+        widened = False
+        for i in cands :
+            if modes[i] in absForm :
+                v = peekNum(vars, prog[i].arg.val)
+                if v is None or v > 255 :
+                    modes[i] = absForm[modes[i]]
+                    widened = True
+        if not widened and vars == prev :
+            return modes, vars
+    raise AsmError("addresses did not settle after %d passes" % maxRelax)
+
+def relaxStats(prog, modes) :
+    """(operands moved to zero page, bytes saved, cycles saved once through each)."""
+    n = saved = 0
+    for l,mode in zip(prog, modes) :
+        if l.typ == 'op' and mode != l.arg.typ :
+            n += 1
+            saved += cycles[l.op, l.arg.typ] - cycles[l.op, mode]
+    return n, n, saved
+
+def asmPass(vars, prog, reqVar, modes=None, addrs=None) :
+    """
+    Run every line, returning (base address, bytes).  If addrs is a dict
+    it maps the address of each line that emits bytes to its line number.
+    """
     vars['*'] = 0
 
-    # XXX upgrades from abs to zpg
     base = None
     x = []
     try :
         lno = 0
-        for l in prog :
+        for l,mode in zip(prog, modes or [None] * len(prog)) :
             lno += 1
             dot = vars['*']
-            bs = execLine(vars, l, reqVar)
+            bs = execLine(vars, l, reqVar, mode)
             if bs :
+                if addrs is not None :
+                    addrs[dot] = lno
                 if base is None :
                     base = dot
                 # pad out to current dot
@@ -550,23 +656,408 @@ def asmPass(vars, prog, reqVar) :
     except AsmError, e :
         print 'line %d: %s' % (lno, e)
 
-def asmProg(prog) :
-    vars = {'*': '0'}
+def resolve(prog, zpg=True) :
+    """
+    The symbol table and addressing modes (None for the parsed ones) for
+    the final pass, or None after reporting an error.  With zpg set
+    operands are relaxed to zero page where they fit.
+    """
+    if zpg :
+        try :
+            modes,vars = relax(prog)
+        except AsmError, e :
+            print e
+            return
+        return vars, modes
+    vars = {'*': 0}
     #print 'pass 1'
     if asmPass(vars, prog, 0) is None :
         return
+    return vars, None
+
+def optimise(prog, stats=None) :
+    """Run the peephole optimiser over a parsed program (see peep.py)."""
+    import peep
+    return peep.optimise(prog, stats)
+
+def asmProg(prog, zpg=True, stats=None, addrs=None, opt=False) :
+    """
+    Assemble a parsed program.  zpg is as for resolve, and if stats is a
+    dict relaxStats is stored in it under 'zpg'.  addrs is as for asmPass.
+    With opt set the program goes through the peephole optimiser first,
+    which puts its own figures in stats.
+    """
+    if opt :
+        prog = optimise(prog, stats)
+    r = resolve(prog, zpg)
+    if r is None :
+        return
+    vars,modes = r
+    if zpg and stats is not None :
+        stats['zpg'] = relaxStats(prog, modes)
     #print 'pass 2'
-    return asmPass(vars, prog, 1)
-    
+    return asmPass(vars, prog, 1, modes, addrs)
+
+def cycleRange(op, mode, dot, bs) :
+    """(min, max) cycles for an instruction assembled to bs at dot."""
+    c = cycles[op, mode]
+    if mode == 'rel' :
+        # not taken, or taken to the same page or another one
+        target = (dot + 2 + bs[1] - (256 if bs[1] & 0x80 else 0)) & 0xffff
+        return c, c + (1 if (target ^ (dot + 2)) & 0xff00 == 0 else 2)
+    if (op, mode) in pageCross and (mode == 'ind,Y' or bs[1] != 0) :
+        # indexing from the start of a page can't cross it
+        return c, c + 1
+    return c, c
+
+def listProg(prog, zpg=True) :
+    """
+    Assemble a parsed program into listing rows (line number, address,
+    bytes, op, mode, min cycles, max cycles), with op None for lines
+    that aren't instructions.  Returns None after reporting an error.
+    """
+    r = resolve(prog, zpg)
+    if r is None :
+        return
+    vars,modes = r
+    vars['*'] = 0
+    rows = []
+    try :
+        lno = 0
+        for l,mode in zip(prog, modes or [None] * len(prog)) :
+            lno += 1
+            dot = vars['*']
+            bs = execLine(vars, l, 1, mode)
+            if l.typ == 'op' :
+                mode = mode or l.arg.typ
+                rows.append((lno, dot, bs, l.op, mode) + cycleRange(l.op, mode, dot, bs))
+            else :
+                rows.append((lno, vars['*'], bs, None, None, 0, 0))
+    except AsmError, e :
+        print 'line %d: %s' % (lno, e)
+        return
+    return rows
+
+def loops(rows) :
+    """
+    The loops in a listing: for every branch or jmp back to an address
+    at or before itself, (first row, last row, min, max), where min and
+    max are the cycles for one time round with the jump back taken,
+    not counting any times round the loops inside it.
+    """
+    found = []
+    for j,(lno,dot,bs,op,mode,lo,hi) in enumerate(rows) :
+        if mode == 'rel' :
+            target = (dot + 2 + bs[1] - (256 if bs[1] & 0x80 else 0)) & 0xffff
+            taken = hi
+        elif (op, mode) == ('jmp', 'abs') :
+            target = bs[1] | (bs[2] << 8)
+            taken = hi
+        else :
+            continue
+        if target > dot :
+            continue
+        i = j
+        while i > 0 and rows[i-1][1] >= target and rows[i-1][1] <= dot :
+            i -= 1
+        if rows[i][1] != target :
+            continue
+        body = [r for r in rows[i:j] if r[3]]
+        found.append((i, j, sum(r[5] for r in body) + taken, sum(r[6] for r in body) + taken))
+    return found
+
+def listing(fn, zpg=True, opt=False) :
+    """Print a listing of fn with the cycles of each instruction, each label's block and each loop."""
+    prog = parseFile(fn)
+    if prog is None :
+        return
+    if opt :
+        prog = optimise(prog)
+    rows = listProg(prog, zpg)
+    if rows is None :
+        return
+    src = file(fn).read().split('\n')
+    for lno,dot,bs,op,mode,lo,hi in rows :
+        cyc = ('%d' % lo if lo == hi else '%d-%d' % (lo, hi)) if op else ''
+        print '%04x  %-9s %5s  %5d: %s' % (dot, ' '.join('%02x' % b for b in bs), cyc, lno, src[lno-1])
+
+    # straight line totals from each label to the next
+    print
+    print '%-16s %5s %6s %6s' % ('label', 'bytes', 'min', 'max')
+    blocks = []
+    for lno,dot,bs,op,mode,lo,hi in rows :
+        l = prog[lno-1]
+        if l.typ == 'setvar' or not blocks :
+            blocks.append([l.var if l.typ == 'setvar' else '(start)', 0, 0, 0])
+        b = blocks[-1]
+        b[1] += len(bs)
+        b[2] += lo
+        b[3] += hi
+    for name,n,lo,hi in blocks :
+        print '%-16s %5d %6d %6d' % (name, n, lo, hi)
+
+    lps = loops(rows)
+    if lps :
+        print
+        for i,j,lo,hi in lps :
+            cyc = '%d' % lo if lo == hi else '%d-%d' % (lo, hi)
+            inner = [1 for ii,jj,l,h in lps if i <= ii and jj <= j and (ii,jj) != (i,j)]
+            print 'loop at lines %d-%d: %s cycles per time round%s' % (rows[i][0], rows[j][0], cyc, ' plus the loops inside it' if inner else '')
+
+def symbols(prog, dots) :
+    """The pass 1 symbol table, given the address before each line."""
+    vars = {}
+    for l,dot in zip(prog, dots) :
+        if l.typ == 'setvar' :
+            vars[l.var] = dot
+    return vars
+
+def packVal(v) :
+    """A Val as nested tuples, which marshal loads far faster than pickle loads objects."""
+    return (v.typ,) + tuple((k, packVal(x) if isinstance(x, Val) else x) for k,x in ((k, getattr(v, k)) for k in v.keys))
+
+def unpackVal(t) :
+    v = Val.__new__(Val)
+    d = v.__dict__
+    d['typ'] = t[0]
+    d['keys'] = [k for k,x in t[1:]]
+    for k,x in t[1:] :
+        d[k] = unpackVal(x) if type(x) is tuple else x
+    return v
+
+# Incremental assembly cache, marshalled next to the source.  It holds
+# the source's hash and lines, the parse of each distinct line, the
+# address before every line in pass 1 (and after the last), and the
+# result with its address to line map.
+cacheVersion = 4
+
+def cacheName(fn) :
+    return fn + '.cache'
+
+def loadCache(cfn) :
+    try :
+        c = marshal.load(file(cfn, 'rb'))
+        if c.get('version') == cacheVersion :
+            return c
+    except Exception :
+        pass
+
+def saveCache(cfn, c) :
+    tmp = cfn + '.tmp'
+    f = file(tmp, 'wb')
+    marshal.dump(c, f)
+    f.close()
+    os.rename(tmp, cfn)
+
+def asmCached(fn, cfn=None, zpg=True, stats=None, addrs=None, opt=False) :
+    """
+    Assemble fn, reusing what an earlier run cached.  Lines seen before
+    are not parsed again.  Without zero page relaxation pass 1 restarts
+    at the first changed line: pass 1 ignores symbol values, so each
+    line's address depends only on the lines before it, and once the
+    unchanged tail of the file is reached at the address it had last
+    time, the rest of pass 1 is reused.  Relaxation depends on symbol
+    values, so with zpg set it runs over the whole program, as does the
+    optimiser with opt set.  Otherwise stats gets the number of lines
+    pass 1 had to run under 'pass1'.
+    """
+    cfn = cfn or cacheName(fn)
+    src = file(fn).read()
+    h = hashlib.sha1(src).hexdigest()
+    old = loadCache(cfn)
+    if old is not None and old['hash'] == h and (old['zpg'], old['opt']) == (zpg, opt) :
+        if stats is not None :
+            stats.update(old['stats'])
+            if 'pass1' in stats :
+                stats['pass1'] = 0
+        if addrs is not None :
+            addrs.update(old['addrs'])
+        base,bs = old['result']
+        return base, list(bs)
+    if old is None or old['dots'] is None :
+        old = {'lines': [], 'parsed': old['parsed'] if old else {}, 'dots': [0]}
+    lines = re.findall(r'[^\n]*\n|[^\n]+$', src)
+    oldLines = old['lines']
+    n,m = len(lines), len(oldLines)
+    pre = 0
+    while pre < min(n, m) and lines[pre] == oldLines[pre] :
+        pre += 1
+    suf = 0
+    while suf < min(n, m) - pre and lines[n-1-suf] == oldLines[m-1-suf] :
+        suf += 1
+
+    packed = old['parsed']
+    parsed = {}
+    prog = []
+    for lno,l in enumerate(lines, 1) :
+        v = parsed.get(l)
+        if v is None :
+            if l in packed :
+                v = unpackVal(packed[l])
+            else :
+                v = parseOne(l, lno)
+                if v is None :
+                    return None
+            parsed[l] = v
+        prog.append(v)
+
+    st = {}
+    am = {}
+    if zpg or opt :
+        r = asmProg(prog, zpg, st, am, opt)
+        dots = None
+    else :
+        r = asmIncremental(prog, old['dots'], pre, n - suf, m - n, am, st)
+        dots = r and r[2]
+        r = r and r[:2]
+    if r is not None :
+        if stats is not None :
+            stats.update(st)
+        if addrs is not None :
+            addrs.update(am)
+        packed = dict((l, packed[l] if l in packed else packVal(v)) for l,v in parsed.items())
+        saveCache(cfn, {'version': cacheVersion, 'hash': h, 'zpg': zpg, 'opt': opt, 'stats': st, 'addrs': am, 'lines': lines, 'parsed': packed, 'dots': dots, 'result': r})
+    return r
+
+def asmIncremental(prog, oldDots, pre, tail, shift, addrs=None, stats=None) :
+    """
+    Assemble without relaxation, rerunning pass 1 from line pre.  Lines
+    from tail on are unchanged and were shift lines further on in the
+    run oldDots came from.  Returns (base, bytes, dots).  addrs is as for
+    asmPass, and if stats is a dict the number of lines pass 1 ran is
+    stored in it under 'pass1'.
+    """
+    n = len(prog)
+    dots = oldDots[:pre+1]
+    vars = symbols(prog[:pre], dots)
+    i = pre
+    try :
+        while i < n :
+            j = i + shift
+            if i >= tail and dots[i] == oldDots[j] :
+                dots += oldDots[j+1:]
+                break
+            vars['*'] = dots[i]
+            execLine(vars, prog[i], 0)
+            dots.append(vars['*'])
+            i += 1
+    except AsmError, e :
+        print 'line %d: %s' % (i+1, e)
+        return None
+    if stats is not None :
+        stats['pass1'] = i - pre
+
+    r = asmPass(symbols(prog, dots), prog, 1, None, addrs)
+    if r is not None :
+        return r + (dots,)
+
 # XXX capture first address
-def asm(fn) :
+def asm(fn, cache=False, zpg=True, stats=None, addrs=None, opt=False) :
+    """
+    Assemble fn, returning (base address, bytes).  With cache set, use
+    asmCached.  zpg, stats, addrs and opt are as for asmProg.
+    """
+    if cache :
+        return asmCached(fn, zpg=zpg, stats=stats, addrs=addrs, opt=opt)
     prog = parseFile(fn)
     if prog is not None :
-        return asmProg(prog)
-
-for fn in sys.argv[1:] :
-    print fn
-    r = asm(fn)
-    if r :
-        base,bs = r
-        print '%04x: %s' % (base, ' '.join('%02x' % b for b in bs))
+        return asmProg(prog, zpg, stats, addrs, opt)
+
+# Relocatable objects.  Code before the first "* =" goes in a section
+# the linker places, and each "* =" starts one at a fixed address.  Every
+# operand that names a label assembles as zero with a relocation, so the
+# label can be in another module.  Labels can't be relaxed to zero page
+# since their values aren't known until link time; numbers still are.
+# Labels starting with _ are local: the linker only resolves them within
+# their own module, so every module can have its own _loop.
+objVersion = 1
+
+def objName(fn) :
+    return os.path.splitext(fn)[0] + '.o'
+
+def isLocal(name) :
+    return name.startswith('_')
+
+def asmObject(prog) :
+    """
+    Assemble a parsed program into an object, a dict holding
+        'sections': [(origin, bytes)], origin None for placed sections
+        'symbols': {name: (section, offset)}
+        'relocs': [(section, offset, kind, name)], kind 'word', 'byte' or 'rel'
+    Returns None after reporting an error.
+    """
+    secs = [[None, []]]
+    syms = {}
+    relocs = []
+    lno = 0
+    try :
+        for l in prog :
+            lno += 1
+            org,bs = secs[-1]
+            if l.typ == 'setdot' :
+                if l.val.typ != 'int' :
+                    raise AsmError("origin must be a number in an object file")
+                secs.append([l.val.val, []])
+            elif l.typ == 'setvar' :
+                if l.var in syms :
+                    raise AsmError("%s defined twice" % l.var)
+                syms[l.var] = len(secs) - 1, len(bs)
+            elif l.typ == 'op' :
+                mode = l.arg.typ
+                v = getattr(l.arg, 'val', None)
+                if v is not None and v.typ == 'var' :
+                    opnum,sz = opTab[l.op, mode]
+                    kind = 'rel' if mode == 'rel' else 'word' if sz == 3 else 'byte'
+                    relocs.append((len(secs) - 1, len(bs) + 1, kind, v.name))
+                    bs += [opnum] + [0] * (sz - 1)
+                    continue
+                if v is not None and mode in zpgForm and v.val <= 255 and (l.op, zpgForm[mode]) in opTab :
+                    mode = zpgForm[mode]
+                if mode == 'rel' and org is None :
+                    raise AsmError("branch to a fixed address from a placed section")
+                vars = {'*': (org or 0) + len(bs)}
+                bs += execLine(vars, l, 1, mode)
+    except AsmError, e :
+        print 'line %d: %s' % (lno, e)
+        return
+    return {'version': objVersion,
+            'sections': [(org, ''.join(chr(b) for b in bs)) for org,bs in secs],
+            'symbols': syms, 'relocs': relocs}
+
+def loadObject(ofn) :
+    o = marshal.load(file(ofn, 'rb'))
+    if not isinstance(o, dict) or o.get('version') != objVersion :
+        raise AsmError("%s is not an object file" % ofn)
+    return o
+
+def saveObject(ofn, o) :
+    saveCache(ofn, o)
+
+if __name__ == '__main__' :
+    opts,args = getopt.getopt(sys.argv[1:], 'lOc')
+    opts = dict(opts)
+    opt = '-O' in opts
+    for fn in args :
+        print fn
+        if '-l' in opts :
+            listing(fn, opt=opt)
+            continue
+        if '-c' in opts :
+            prog = parseFile(fn)
+            if prog is None :
+                continue
+            if opt :
+                prog = optimise(prog)
+            o = asmObject(prog)
+            if o is not None :
+                saveObject(objName(fn), o)
+            continue
+        stats = {}
+        r = asm(fn, stats=stats, opt=opt)
+        if r :
+            base,bs = r
+            print '%04x: %s' % (base, ' '.join('%02x' % b for b in bs))
+            print 'zero page: %d operands, %d bytes and %d cycles saved' % stats['zpg']
+            for name,(n,saved,cyc) in sorted(stats.get('peep', {}).items()) :
+                if n :
+                    print '%s: %d rewrites, %d bytes and %d cycles saved' % (name, n, saved, cyc)
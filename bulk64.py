@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Copy many files in or out of a d64 image in one go.
+
+    bulk64.py import image.d64 dir-or-manifest
+    bulk64.py export image.d64 dir
+
+Import takes every .prg/.seq/.usr file in a directory, or the files
+listed in a manifest with one "hostfile [NAME [type]]" per line, and
+writes them all with a single directory/BAM update and one ordered pass
+of data writes.  The image is created if it does not exist.  Export
+writes every file in the image to dir as NAME.type, or NAME_2.type and
+so on when names only differ in characters the host can't use.
+"""
+import os, sys
+import d64
+
+extTyp = dict((ext, typ) for typ,ext in d64.typExt.items())
+
+def diskName(fn) :
+    """Default C64 file name for a host file."""
+    nm = os.path.splitext(os.path.basename(fn))[0]
+    return nm.upper()[:16]
+
+def hostName(nm) :
+    """Host-safe version of a C64 file name."""
+    return ''.join(ch if ch.isalnum() or ch in '-_.' else '_' for ch in nm) or '_'
+
+def uniqueName(used, nm, ext) :
+    """
+    A host file name for nm that isn't in used, adding _2, _3... when
+    two C64 names map to the same host name.  Names are compared
+    ignoring case, for case-insensitive file systems.
+    """
+    base = hostName(nm)
+    fn = '%s.%s' % (base, ext)
+    n = 1
+    while fn.lower() in used :
+        n += 1
+        fn = '%s_%d.%s' % (base, n, ext)
+    used.add(fn.lower())
+    return fn
+
+def fileTyp(fn, default='prg') :
+    ext = os.path.splitext(fn)[1][1:].lower() or default
+    if ext not in extTyp :
+        raise d64.Error("unknown file type %r for %s" % (ext, fn))
+    return extTyp[ext]
+
+def readManifest(fn) :
+    """Return a list of (hostfile, name, type) from a manifest."""
+    base = os.path.dirname(fn)
+    ents = []
+    for lno,l in enumerate(file(fn), 1) :
+        ws = l.split('#', 1)[0].split()
+        if not ws :
+            continue
+        host = os.path.join(base, ws[0])
+        nm = ws[1] if len(ws) > 1 else diskName(host)
+        if len(ws) > 2 :
+            if ws[2].lower() not in extTyp :
+                raise d64.Error("%s line %d: unknown file type %r" % (fn, lno, ws[2]))
+            typ = extTyp[ws[2].lower()]
+        else :
+            typ = fileTyp(host)
+        ents.append((host, nm, typ))
+    return ents
+
+def scanDir(dn) :
+    ents = []
+    for fn in sorted(os.listdir(dn)) :
+        ext = os.path.splitext(fn)[1][1:].lower()
+        if ext in ('prg', 'seq', 'usr') :
+            ents.append((os.path.join(dn, fn), diskName(fn), extTyp[ext]))
+    return ents
+
+def importFiles(img, src) :
+    if os.path.isdir(src) :
+        ents = scanDir(src)
+    else :
+        ents = readManifest(src)
+    if not os.path.exists(img) :
+        d64.newImage(img, diskName(img))
+    files = [(nm, file(host, 'rb').read(), typ) for host,nm,typ in ents]
+    with d64.Disk(img, mm=True) as d :
+        d.begin()
+        try :
+            d.importFiles(files)
+        except :
+            d.rollback()
+            raise
+        d.commit()
+        print '%s: wrote %d files, %d blocks free' % (img, len(files), d.blocksFree())
+
+def exportFiles(img, dst) :
+    if not os.path.isdir(dst) :
+        os.makedirs(dst)
+    n = 0
+    used = set()
+    with d64.Disk(img, mm=True, ro=True) as d :
+        for nm,bs,typ in d.exportFiles() :
+            ext = d64.typExt.get(0x80 | (typ & 7), 'prg')
+            f = file(os.path.join(dst, uniqueName(used, nm, ext)), 'wb')
+            f.write(bs)
+            f.close()
+            n += 1
+    print '%s: extracted %d files' % (img, n)
+
+def main() :
+    if len(sys.argv) != 4 or sys.argv[1] not in ('import', 'export') :
+        print __doc__
+        sys.exit(1)
+    cmd,img,path = sys.argv[1:]
+    try :
+        if cmd == 'import' :
+            importFiles(img, path)
+        else :
+            exportFiles(img, path)
+    except d64.Error, e :
+        print 'error:', e
+        sys.exit(1)
+
+if __name__ == '__main__' :
+    main()
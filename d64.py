@@ -2,32 +2,45 @@
 """
 See http://unusedino.de/ec64/technical/formats/d64.html
 """
-import struct
+import os, struct, mmap, array, zlib
 
 class Error(Exception) :
     pass
 
-Sanity = True
-#Sanity = False
+Sanity = False  # set to verify every Disk, as if opened with verify=True
+#Sanity = True
 
 def pad(s, n, ch) :
     while len(s) < n :
         s += ch
     return s
 
-def decBAM(tno, bs) :
-    fr,b0,b1,b2 = bs
-    bs = (b2<<16) | (b1<<8) | b0
-    bits = set(b for b in xrange(24) if (bs & (1<<b)) != 0)
-    if fr != len(bits) :
-        print "warning: wrong free bits for track %d - %d actual vs %d" % (tno, len(bits), fr)
-    return bits
+def bitCount(bits) :
+    return bin(bits).count('1')
 
-def encBAM(fr) :
-    bits = 0
-    for b in fr :
-        bits |= (1 << b)
-    return len(fr), (bits>>0)&0xff, (bits >> 8)&0xff, (bits >> 16) & 0xff
+def encBAM(bits, cnt) :
+    return cnt, (bits>>0)&0xff, (bits >> 8)&0xff, (bits >> 16) & 0xff
+
+def unpackEntries(bs, off, n, sz) :
+    """Unpack n BAM entries of sz bytes (free count then little endian bitmap) starting at off."""
+    ents = []
+    for t in xrange(n) :
+        raw = bytearray(bs[off + t*sz : off + (t+1)*sz])
+        bits = 0
+        for b in reversed(raw[1:]) :
+            bits = (bits << 8) | b
+        ents.append((raw[0], bits))
+    return ents
+
+def packBits(bits, n) :
+    return ''.join(chr((bits >> (8*k)) & 0xff) for k in xrange(n))
+
+def packEntries(bam, counts, sz) :
+    return ''.join(chr(c) + packBits(bits, sz-1) for bits,c in zip(bam, counts))
+
+def firstBit(bits) :
+    """Index of the lowest set bit."""
+    return (bits & -bits).bit_length() - 1
 
 class BAM(object) :
     """
@@ -50,39 +63,191 @@ class BAM(object) :
          AC-BF: DOLPHIN DOS track 36-40 BAM entries (only for 40 track)
          C0-D3: SPEED DOS track 36-40 BAM entries (only for 40 track)
     """
-    def __init__(self) :
-        pass
+    dosType = '2A'
+    version = 0x41
+
+    def __init__(self, fmt=None) :
+        self.fmt = fmt or d64Format
 
     def fromBytes(self, bs) :
-        assert len(bs) == 256
+        """Parse the BAM from the concatenated contents of fmt.bamSecs."""
+        assert len(bs) == 256 * len(self.fmt.bamSecs)
+        self.header(bs)
+        # per track: bitmap of free sectors (bit n set = sector n free) and its popcount
+        self.bam = []
+        self.counts = []
+        for n,(fr,bits) in enumerate(self.rawEntries(bs)) :
+            cnt = bitCount(bits)
+            if fr != cnt :
+                print "warning: wrong free bits for track %d - %d actual vs %d" % (n+1, cnt, fr)
+            self.bam.append(bits)
+            self.counts.append(cnt)
+        self.nfree = sum(self.counts)
+        return self
+
+    def header(self, bs) :
         t,s,v,z = struct.unpack("<BBBB", bs[0:4])
-        rawBams = [struct.unpack("<BBBB", bs[4 + 4*n : 4 + 4 + 4*n]) for n in xrange(35)]
         nm = bs[0x90:0xa0].rstrip('\xa0')
         did,a0,dtyp = struct.unpack("<HBH", bs[0xa2 : 0xa7])
         self.dir = (t,s)
         self.ver = v
+        self.flag = z      # 0x80 on double sided 1571 disks
         self.name = nm
         self.id = did
         self.a0 = a0       # worth tracking?
         self.dtype = dtyp
-        self.bam = [decBAM(n,rb) for n,rb in enumerate(rawBams)]
-        return self
+
+    def rawEntries(self, bs) :
+        """(free count as stored, bitmap) for every track, without any checking."""
+        ents = unpackEntries(bs, 4, 35, 4)
+        if self.fmt.tracks == 40 :
+            # DOLPHIN DOS or SPEED DOS, whichever is in use
+            self.ext = 0xac
+            for off in (0xac, 0xc0) :
+                if any(bytearray(bs[off : off + 20])) :
+                    self.ext = off
+                    break
+            ents += unpackEntries(bs, self.ext, 5, 4)
+        return ents
 
     def toBytes(self) :
-        d1 = struct.pack('<BBBB', self.dir[0], self.dir[1], self.ver, 0)
-        rawBams = ''.join(struct.pack('<BBBB', *encBAM(b)) for b in self.bam)
+        d1 = struct.pack('<BBBB', self.dir[0], self.dir[1], self.ver, self.flag)
+        rawBams = packEntries(self.bam[:35], self.counts[:35], 4)
         d2 = struct.pack('<HBH', self.id, self.a0, self.dtype)
         zeros = '\0' * 85
+        if self.fmt.tracks == 40 :
+            ext = packEntries(self.bam[35:], self.counts[35:], 4)
+            zeros = zeros[:self.ext - 0xab] + ext + zeros[self.ext - 0xab + len(ext):]
         d = d1 + rawBams + pad(self.name, 16, '\xa0') + '\xa0\xa0' + d2 + '\xa0\xa0\xa0\xa0' + zeros
         assert len(d) == 256
         return d
 
+    def format(self, name, did) :
+        """Set up the BAM of a freshly formatted disk."""
+        self.dir = self.fmt.dirStart
+        self.ver = self.version
+        self.flag = 0
+        self.name = name
+        self.id, = struct.unpack('<H', did)
+        self.a0 = 0xa0
+        self.dtype, = struct.unpack('<H', self.dosType)
+        self.ext = 0xac
+        spt = self.fmt.spt[1:]
+        self.bam = [(1 << n) - 1 for n in spt]
+        self.counts = list(spt)
+        self.nfree = sum(spt)
+        for t in self.fmt.sysTracks :
+            for s in xrange(self.fmt.spt[t]) :
+                self.allocate(t, s)
+        for t,s in self.fmt.bamSecs + [self.fmt.dirStart] :
+            if self.isFree(t, s) :
+                self.allocate(t, s)
+        return self
+
+    def isFree(self, t, s) :
+        return (self.bam[t-1] >> s) & 1 == 1
+    def trackFree(self, t) :
+        return self.counts[t-1]
+    def firstFree(self, t) :
+        """Lowest free sector on track t, or None."""
+        if self.counts[t-1] :
+            return firstBit(self.bam[t-1])
+    def freeSectors(self, t) :
+        bits = self.bam[t-1]
+        return [s for s in xrange(bits.bit_length()) if (bits >> s) & 1]
+
+    def allocate(self, t, s) :
+        m = 1 << s
+        if not self.bam[t-1] & m :
+            raise Error("sector %d/%d is already in use" % (t,s))
+        self.bam[t-1] &= ~m
+        self.counts[t-1] -= 1
+        self.nfree -= 1
+    def release(self, t, s) :
+        m = 1 << s
+        if self.bam[t-1] & m :
+            raise Error("sector %d/%d is already free" % (t,s))
+        self.bam[t-1] |= m
+        self.counts[t-1] += 1
+        self.nfree += 1
+
     def __str__(self) :
         def tfree(n, f) :
-            return '[%d: %s]' % (n, ' '.join(('%d' % sect) for sect in sorted(f)))
+            return '[%d: %s]' % (n, ' '.join(('%d' % sect) for sect in self.freeSectors(n+1)))
         free = '[free %s]' % ' '.join(tfree(n, f) for (n,f) in enumerate(self.bam))
         return '[BAM %r dir@%s ver %x, ID %x, disk %x free: %s]' % (self.name, self.dir, self.ver, self.id, self.dtype, free)
 
+class BAM71(BAM) :
+    """
+    Double sided 1571 BAM.  Side one is as on the 1541, with the double
+    sided flag $80 in byte 03 of 18/0.  Free counts for tracks 36-70 are
+    at $DD-$FF of 18/0 and their bitmaps, three bytes each, start 53/0.
+    """
+    def rawEntries(self, bs) :
+        ents = unpackEntries(bs, 4, 35, 4)
+        for n in xrange(35) :
+            b0,b1,b2 = bytearray(bs[0x100 + 3*n : 0x100 + 3*n + 3])
+            ents.append((ord(bs[0xdd + n]), b0 | (b1 << 8) | (b2 << 16)))
+        return ents
+
+    def toBytes(self) :
+        d = BAM.toBytes(self)[:0xdd] + ''.join(chr(c) for c in self.counts[35:])
+        d += pad(''.join(packBits(bits, 3) for bits in self.bam[35:]), 256, '\0')
+        assert len(d) == 512
+        return d
+
+    def format(self, name, did) :
+        BAM.format(self, name, did)
+        self.flag = 0x80
+        return self
+
+class BAM81(BAM) :
+    """
+    1581 header and BAM.  40/0 holds the header:
+         00-01: first directory sector (40/3)
+            02: DOS version 'D'
+         04-13: Disk Name (padded with $A0)
+         16-17: Disk ID
+         19-1A: DOS type "3D"
+    40/1 and 40/2 hold the BAM for tracks 1-40 and 41-80:
+         00-01: link to the next BAM sector (40/2, then 00/FF)
+         02-03: version 'D' and its complement
+         04-05: Disk ID
+            06: I/O byte
+            07: Auto-boot flag
+         10-FF: six bytes per track, the free count and a 40 bit map
+    """
+    dosType = '3D'
+    version = 0x44
+
+    def header(self, bs) :
+        t,s,v = struct.unpack("<BBB", bs[0:3])
+        self.dir = (t,s)
+        self.ver = v
+        self.flag = 0
+        self.name = bs[0x04:0x14].rstrip('\xa0')
+        self.id,self.a0,self.dtype = struct.unpack("<HBH", bs[0x16 : 0x1b])
+        self.io,self.boot = struct.unpack("<BB", bs[0x106 : 0x108])
+
+    def rawEntries(self, bs) :
+        return unpackEntries(bs, 0x110, 40, 6) + unpackEntries(bs, 0x210, 40, 6)
+
+    def toBytes(self) :
+        d = struct.pack('<BBBB', self.dir[0], self.dir[1], self.ver, 0) + pad(self.name, 16, '\xa0') + '\xa0\xa0'
+        d += struct.pack('<HBH', self.id, self.a0, self.dtype) + '\xa0\xa0'
+        d = pad(d, 256, '\0')
+        for n,link in enumerate([(40,2), (0,0xff)]) :
+            h = struct.pack('<BBBBHBB', link[0], link[1], self.ver, self.ver ^ 0xff, self.id, self.io, self.boot)
+            d += pad(h, 16, '\0') + packEntries(self.bam[40*n : 40*n + 40], self.counts[40*n : 40*n + 40], 6)
+        assert len(d) == 768
+        return d
+
+    def format(self, name, did) :
+        BAM.format(self, name, did)
+        self.io = 0xc0
+        self.boot = 0
+        return self
+
 class Dirent(object) :
     """
     Bytes: $00-1F: First directory entry
@@ -185,75 +350,716 @@ geom = {
     35: (17, 666),
 }
 
-def getSecOffset(t, s) :
-    if t not in geom :
-        raise Error("bad track number %d" % t)
-    ns,off = geom[t]
-    if s < 0 or s >= ns :
-        raise Error("bad sector number %d for track %d" % (t,s))
-    return off + s
+# file type => host file extension
+typExt = {
+    0x80: 'del',
+    0x81: 'seq',
+    0x82: 'prg',
+    0x83: 'usr',
+    0x84: 'rel',
+}
+
+class Format(object) :
+    """
+    Layout of an image type: sectors per track, where the BAM and the
+    directory live, the BAM class that parses it and the DOS interleaves.
+    Sector offsets are precomputed into one flat table indexed by
+    track * maxSecs + sector, holding -1 for sectors that don't exist.
+    """
+    def __init__(self, name, spt, dirStart, bamSecs, bamClass, interleave, dirInterleave, sysTracks=(), superSide=False) :
+        self.name = name
+        self.spt = [0] + list(spt)
+        self.tracks = len(spt)
+        self.maxSecs = max(spt)
+        self.dirStart = dirStart
+        self.dirTrack = dirStart[0]
+        self.bamSecs = bamSecs
+        self.bamClass = bamClass
+        self.interleave = interleave
+        self.dirInterleave = dirInterleave
+        self.sysTracks = sysTracks   # tracks the DOS keeps entirely to itself
+        self.superSide = superSide   # REL files have a super side sector over groups of 6 side sectors
+
+        self.offs = array.array('i', [-1]) * ((self.tracks + 1) * self.maxSecs)
+        off = 0
+        for t,ns in enumerate(spt) :
+            base = (t+1) * self.maxSecs
+            for s in xrange(ns) :
+                self.offs[base + s] = off + s
+            off += ns
+        self.total = off
+        self.size = off * 256
 
-def readSector(fn, t, s) :
-    f = file(fn, 'r+b')
-    f.seek(getSecOffset(t,s) * 256)
+    def offset(self, t, s) :
+        """Sector number of t/s counting from the start of the image."""
+        if 0 <= s < self.maxSecs and t >= 0 :
+            i = t * self.maxSecs + s
+            if i < len(self.offs) and self.offs[i] >= 0 :
+                return self.offs[i]
+        raise Error("bad sector %d/%d for %s" % (t, s, self.name))
+
+    def sizes(self) :
+        """Image sizes without and with the per-sector error info bytes."""
+        return self.size, self.size + self.total
+
+    def newBAM(self) :
+        return self.bamClass(self)
+
+    def __repr__(self) :
+        return '[Format %s]' % self.name
+
+spt1541 = [geom[t][0] for t in sorted(geom)]
+d64Format = Format('d64', spt1541, (18,1), [(18,0)], BAM, 10, 3)
+d64x40Format = Format('d64-40', spt1541 + [17]*5, (18,1), [(18,0)], BAM, 10, 3)
+d71Format = Format('d71', spt1541 * 2, (18,1), [(18,0), (53,0)], BAM71, 6, 3, sysTracks=(53,))
+d81Format = Format('d81', [40] * 80, (40,3), [(40,0), (40,1), (40,2)], BAM81, 1, 1, superSide=True)
+formats = [d64Format, d64x40Format, d71Format, d81Format]
+
+def formatFor(size) :
+    """Guess an image's format from its size."""
+    for fmt in formats :
+        if size in fmt.sizes() :
+            return fmt
+    raise Error("unknown image size %d" % size)
+
+def getSecOffset(t, s, fmt=d64Format) :
+    return fmt.offset(t, s)
+
+def rotateFirst(bits, n, s) :
+    """First set bit of an n bit map at or after bit s, wrapping around."""
+    rot = ((bits >> s) | (bits << (n - s))) & ((1 << n) - 1)
+    if rot :
+        return (s + firstBit(rot)) % n
+
+class DosAlloc(object) :
+    """
+    Sector allocation as done by the 1541 DOS.  A file starts on the
+    track closest to the directory that has room, trying the lower side
+    first.  Each following sector is `interleave` sectors further round
+    the track; when a track fills up the file moves one track further
+    from the directory, and to the other side once it reaches the edge.
+    Directory sectors are `dirInterleave` apart on the directory track.
+    Interleaves default to the ones the drive for the image's format uses.
+    """
+    def __init__(self, interleave=None, dirInterleave=None) :
+        self.interleave = interleave
+        self.dirInterleave = dirInterleave
+
+    def step(self, bam) :
+        return self.interleave or bam.fmt.interleave
+    def dirStep(self, bam) :
+        return self.dirInterleave or bam.fmt.dirInterleave
+
+    def trackOrder(self, fmt) :
+        ts = [t for t in xrange(1, fmt.tracks+1) if t != fmt.dirTrack]
+        return sorted(ts, key=lambda t : (abs(t - fmt.dirTrack), t))
+
+    def nextTracks(self, fmt, t) :
+        """Tracks to try, in order, once track t is full."""
+        lo = range(fmt.dirTrack-1, 0, -1)
+        hi = range(fmt.dirTrack+1, fmt.tracks+1)
+        if t < fmt.dirTrack :
+            return lo[lo.index(t)+1:] + hi + lo[:lo.index(t)]
+        return hi[hi.index(t)+1:] + lo + hi[:hi.index(t)]
+
+    def pick(self, bam, t, s) :
+        """First free sector on track t at or after s, with the DOS wraparound quirk."""
+        n = bam.fmt.spt[t]
+        if s >= n :
+            s -= n
+            if s > 0 :
+                s -= 1
+        return rotateFirst(bam.bam[t-1], n, s % n)
+
+    def first(self, bam) :
+        for t in self.trackOrder(bam.fmt) :
+            if bam.trackFree(t) :
+                return t, self.pick(bam, t, 0)
+        raise Error("disk full")
+
+    def next(self, bam, t, s) :
+        s += self.step(bam)
+        if bam.trackFree(t) :
+            return t, self.pick(bam, t, s)
+        for t in self.nextTracks(bam.fmt, t) :
+            if bam.trackFree(t) :
+                return t, self.pick(bam, t, s % bam.fmt.spt[t])
+        raise Error("disk full")
+
+    def nextDir(self, bam, s) :
+        t = bam.fmt.dirTrack
+        if not bam.trackFree(t) :
+            raise Error("directory full")
+        return t, self.pick(bam, t, s + self.dirStep(bam))
+
+class FastAlloc(DosAlloc) :
+    """
+    Layout for fast loaders that keep the drive busy reading rather than
+    waiting on the host.  Files fill tracks the same way the DOS does but
+    with a tighter interleave, and when a file moves to the next track it
+    continues `skew` sectors on from where it left off, covering the time
+    the head spends stepping, instead of restarting the interleave.
+    """
+    def __init__(self, interleave=4, dirInterleave=None, skew=2) :
+        DosAlloc.__init__(self, interleave, dirInterleave)
+        self.skew = skew
+
+    def next(self, bam, t, s) :
+        if bam.trackFree(t) :
+            return t, self.pick(bam, t, s + self.step(bam))
+        for t2 in self.nextTracks(bam.fmt, t) :
+            if bam.trackFree(t2) :
+                n = bam.fmt.spt[t2]
+                return t2, rotateFirst(bam.bam[t2-1], n, (s + 1 + self.skew) % n)
+        raise Error("disk full")
+
+def readSector(fn, t, s, fmt=d64Format) :
+    f = file(fn, 'rb')
+    f.seek(fmt.offset(t,s) * 256)
     d = f.read(256)
     f.close()
     #print "read", t,s, ' '.join('%02x' % ord(b) for b in d)
     return d
 
-def writeSector(fn, t, s, d) :
+def writeSector(fn, t, s, d, fmt=d64Format) :
     assert len(d) == 256
     #print "write", t,s, ' '.join('%02x' % ord(b) for b in d)
     f = file(fn, 'r+b')
-    f.seek(getSecOffset(t,s) * 256)
+    f.seek(fmt.offset(t,s) * 256)
     d = f.write(d)
     f.close()
 
+# Undo journal: magic, then (sector offset, original 256 bytes) records.
+# A journal on disk means a commit may have been interrupted; replaying
+# it puts back every sector that commit could have touched.
+journalMagic = 'D64JRNL\0'
+journalRec = struct.Struct('<H')
+
+def journalName(fn) :
+    return fn + '.jnl'
+
+def syncDir(fn) :
+    """fsync the directory holding fn so creates/renames/removes are durable."""
+    fd = os.open(os.path.dirname(os.path.abspath(fn)), os.O_RDONLY)
+    try :
+        os.fsync(fd)
+    finally :
+        os.close(fd)
+
+def writeJournal(fn, secs) :
+    """Durably save a list of (sector offset, original data) for fn."""
+    jfn = journalName(fn)
+    f = file(jfn, 'wb')
+    f.write(journalMagic)
+    for off,d in secs :
+        assert len(d) == 256
+        f.write(journalRec.pack(off) + d)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    syncDir(jfn)
+
+def removeJournal(fn) :
+    jfn = journalName(fn)
+    os.remove(jfn)
+    syncDir(jfn)
+
+def recover(fn) :
+    """
+    Roll back an interrupted commit by replaying fn's undo journal.
+    Returns the number of sectors restored, or None if there was no journal.
+    """
+    jfn = journalName(fn)
+    if not os.path.exists(jfn) :
+        return None
+    j = file(jfn, 'rb').read()
+    n = 0
+    if j.startswith(journalMagic) :
+        pos = len(journalMagic)
+        recsz = journalRec.size + 256
+        f = file(fn, 'r+b')
+        # a torn final record was never followed by any image writes
+        while pos + recsz <= len(j) :
+            off, = journalRec.unpack_from(j, pos)
+            f.seek(off * 256)
+            f.write(j[pos + journalRec.size : pos + recsz])
+            pos += recsz
+            n += 1
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+    removeJournal(fn)
+    return n
+
+class FileImage(object) :
+    """Sector access that opens the image file on every access."""
+    atomic = False   # writeSectors replaces the image in one step, no journal needed
+
+    def __init__(self, fn, ro=False, fmt=d64Format) :
+        self.fn = fn
+        self.ro = ro
+        self.fmt = fmt
+    def readSector(self, t, s) :
+        return readSector(self.fn, t, s, self.fmt)
+    def writeSector(self, t, s, d) :
+        if self.ro :
+            raise Error("image is read-only")
+        writeSector(self.fn, t, s, d, self.fmt)
+    def writeSectors(self, secs, durable=False) :
+        """Write a list of (t, s, data) with a single open of the image."""
+        if self.ro :
+            raise Error("image is read-only")
+        f = file(self.fn, 'r+b')
+        for t,s,d in secs :
+            assert len(d) == 256
+            f.seek(self.fmt.offset(t,s) * 256)
+            f.write(d)
+        if durable :
+            f.flush()
+            os.fsync(f.fileno())
+        f.close()
+    def tail(self) :
+        """The bytes after the last sector, such as error info."""
+        f = file(self.fn, 'rb')
+        f.seek(self.fmt.size)
+        d = f.read()
+        f.close()
+        return d
+    def close(self) :
+        pass
+
+class MmapImage(object) :
+    """
+    Sector access through a single mmap of the image.
+    Sectors are returned as zero-copy buffer slices of the map,
+    which are only valid until close().
+    """
+    atomic = False
+
+    def __init__(self, fn, ro=False, fmt=d64Format) :
+        self.fn = fn
+        self.ro = ro
+        self.fmt = fmt
+        self.f = file(fn, 'rb' if ro else 'r+b')
+        acc = mmap.ACCESS_READ if ro else mmap.ACCESS_WRITE
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=acc)
+    def readSector(self, t, s) :
+        return buffer(self.mm, self.fmt.offset(t,s) * 256, 256)
+    def writeSector(self, t, s, d) :
+        assert len(d) == 256
+        if self.ro :
+            raise Error("image is read-only")
+        off = self.fmt.offset(t,s) * 256
+        self.mm[off : off+256] = d
+    def writeSectors(self, secs, durable=False) :
+        # mmap.flush() is a synchronous msync, so this is always durable
+        for t,s,d in secs :
+            self.writeSector(t, s, d)
+        self.flush()
+    def flush(self) :
+        if not self.ro :
+            self.mm.flush()
+    def tail(self) :
+        return self.mm[self.fmt.size:]
+    def close(self) :
+        if self.mm is not None :
+            self.flush()
+            self.mm.close()
+            self.f.close()
+            self.mm = None
+
+# Packed container: magic, format name, chunk count, then a (offset,
+# length) index of zlib chunks, one per track plus one for any error
+# info bytes following the image.
+packMagic = 'D64PACK\0'
+packHeader = struct.Struct('<8s8sI')
+packIndex = struct.Struct('<II')
+
+def isPacked(fn) :
+    f = file(fn, 'rb')
+    magic = f.read(len(packMagic))
+    f.close()
+    return magic == packMagic
+
+def imageFormat(fn) :
+    """The format of a raw or packed image."""
+    if isPacked(fn) :
+        f = file(fn, 'rb')
+        magic,name,n = packHeader.unpack(f.read(packHeader.size))
+        f.close()
+        for fmt in formats :
+            if fmt.name == name.rstrip('\0') :
+                return fmt
+        raise Error("%s: unknown format %r" % (fn, name))
+    return formatFor(os.path.getsize(fn))
+
+def writePacked(fn, chunks, fmt, durable=False) :
+    """Write a container from already compressed chunks, through a temp file and a rename."""
+    pos = packHeader.size + packIndex.size * len(chunks)
+    index = []
+    for c in chunks :
+        index.append(packIndex.pack(pos, len(c)))
+        pos += len(c)
+    tmp = fn + '.tmp'
+    f = file(tmp, 'wb')
+    f.write(packHeader.pack(packMagic, fmt.name, len(chunks)) + ''.join(index) + ''.join(chunks))
+    if durable :
+        f.flush()
+        os.fsync(f.fileno())
+    f.close()
+    if os.path.exists(fn) :
+        os.chmod(tmp, os.stat(fn).st_mode)
+    os.rename(tmp, fn)
+    if durable :
+        syncDir(fn)
+
+def packImage(src, dst, level=6) :
+    """Pack a raw image (with or without error info) into a container."""
+    dat = file(src, 'rb').read()
+    fmt = formatFor(len(dat))
+    chunks = []
+    for t in xrange(1, fmt.tracks + 1) :
+        base = fmt.offset(t, 0) * 256
+        chunks.append(zlib.compress(dat[base : base + fmt.spt[t] * 256], level))
+    chunks.append(zlib.compress(dat[fmt.size:], level))
+    writePacked(dst, chunks, fmt)
+
+def unpackImage(fn) :
+    """The raw bytes of a packed image, error info included."""
+    img = PackedImage(fn, ro=True)
+    try :
+        return ''.join(img.track(t) for t in xrange(1, img.fmt.tracks + 1)) + img.tail()
+    finally :
+        img.close()
+
+class PackedImage(object) :
+    """
+    Sector access to a packed container.  Reading a sector decompresses
+    only its track, and decompressed tracks are cached until close().
+    Writes recompress the touched tracks and replace the container with
+    a rename, so they are atomic.
+    """
+    atomic = True
+
+    def __init__(self, fn, ro=False, fmt=None) :
+        self.fn = fn
+        self.ro = ro
+        self.fmt = fmt or imageFormat(fn)
+        self.cache = {}
+        self.f = None
+        self.open()
+
+    def open(self) :
+        self.f = file(self.fn, 'rb')
+        magic,name,n = packHeader.unpack(self.f.read(packHeader.size))
+        if magic != packMagic or n != self.fmt.tracks + 1 :
+            raise Error("%s is not a packed %s image" % (self.fn, self.fmt.name))
+        raw = self.f.read(packIndex.size * n)
+        self.index = [packIndex.unpack_from(raw, i * packIndex.size) for i in xrange(n)]
+
+    def chunk(self, i) :
+        off,n = self.index[i]
+        self.f.seek(off)
+        return self.f.read(n)
+
+    def track(self, t) :
+        if t not in self.cache :
+            self.cache[t] = zlib.decompress(self.chunk(t - 1))
+        return self.cache[t]
+
+    def tail(self) :
+        return zlib.decompress(self.chunk(self.fmt.tracks))
+
+    def readSector(self, t, s) :
+        off = (self.fmt.offset(t, s) - self.fmt.offset(t, 0)) * 256
+        return buffer(self.track(t), off, 256)
+    def writeSector(self, t, s, d) :
+        self.writeSectors([(t, s, d)])
+    def writeSectors(self, secs, durable=False) :
+        if self.ro :
+            raise Error("image is read-only")
+        touched = {}
+        for t,s,d in secs :
+            assert len(d) == 256
+            if t not in touched :
+                touched[t] = bytearray(self.track(t))
+            off = (self.fmt.offset(t, s) - self.fmt.offset(t, 0)) * 256
+            touched[t][off : off + 256] = d
+        chunks = []
+        for i in xrange(len(self.index)) :
+            t = i + 1
+            if t in touched :
+                self.cache[t] = str(touched[t])
+                chunks.append(zlib.compress(self.cache[t]))
+            else :
+                chunks.append(self.chunk(i))
+        self.f.close()
+        writePacked(self.fn, chunks, self.fmt, durable)
+        self.open()
+    def close(self) :
+        if self.f is not None :
+            self.f.close()
+            self.f = None
+        self.cache = {}
+
 class Disk(object) :
-    def __init__(self, fn) :
+    """
+    A d64 image, or any other image type in `formats`.  The format is
+    picked by the image size unless fmt is given.  With mm set the image is opened once and mapped,
+    otherwise every sector access opens the file.  Packed containers
+    (see packImage) are recognised and opened as a PackedImage either
+    way.  Always close() the disk (or use it in a with statement) when done.
+
+    Writes are held in a write-back cache of dirty sectors and only
+    reach the image on sync(), in sector order.  abort() (or closing
+    without a sync) discards them.
+
+    Sectors for new files and directory blocks are chosen by the `alloc`
+    policy, DosAlloc by default.
+
+    For crash safety wrap updates in begin()/commit() (or rollback()).
+    A commit first saves the original contents of every touched sector
+    to an undo journal next to the image; opening a disk with a leftover
+    journal rolls the interrupted commit back.
+
+    The BAM (bam) and the directory (dir, dirSecs, names, freeEnts) are
+    only read when first used, so opening a disk reads nothing.  With
+    verify set both are checked to re-encode to exactly what was read.
+    """
+    lazy = {
+        'bam': 'readBAM',
+        'dir': 'readDir', 'dirSecs': 'readDir', 'names': 'readDir', 'freeEnts': 'readDir',
+    }
+
+    def __init__(self, fn, mm=False, ro=False, alloc=None, fmt=None, verify=False) :
         self.fn = fn
-        self.readBAM()
-        self.readDir()
+        self.packed = isPacked(fn)
+        self.fmt = fmt or imageFormat(fn)
+        self.alloc = alloc or DosAlloc()
+        self.mm = mm
+        self.ro = ro
+        self.verify = verify or Sanity
+        self.dirty = {}
+        self.txn = False
+        if os.path.exists(journalName(fn)) :
+            if ro :
+                raise Error("%s has an undo journal, open it writable to recover" % fn)
+            recover(fn)
+        self.openImage()
+
+    def __getattr__(self, name) :
+        # only called for attributes not set yet: parse the BAM or directory on demand
+        if name in self.lazy :
+            getattr(self, self.lazy[name])()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def loaded(self, name) :
+        return name in self.__dict__
+
+    def forget(self) :
+        """Drop the parsed BAM and directory so they are read again on next use."""
+        for name in self.lazy :
+            self.__dict__.pop(name, None)
+
+    def openImage(self) :
+        if self.packed :
+            self.img = PackedImage(self.fn, self.ro, self.fmt)
+        elif self.mm :
+            self.img = MmapImage(self.fn, self.ro, self.fmt)
+        else :
+            self.img = FileImage(self.fn, self.ro, self.fmt)
+
+    def close(self) :
+        self.img.close()
+    def __enter__(self) :
+        return self
+    def __exit__(self, typ, val, tb) :
+        self.close()
+
+    def readSector(self, t, s) :
+        off = self.fmt.offset(t, s)
+        if off in self.dirty :
+            return self.dirty[off][2]
+        return self.img.readSector(t, s)
+    def writeSector(self, t, s, d) :
+        assert len(d) == 256
+        self.dirty[self.fmt.offset(t, s)] = t,s,d
+    def flush(self, durable=False) :
+        """Write out all dirty sectors in one ordered pass."""
+        if self.dirty :
+            self.img.writeSectors([self.dirty[off] for off in sorted(self.dirty)], durable)
+            self.dirty = {}
+
     def readBAM(self) :
-        d = readSector(self.fn, 18, 0)
-        self.bam = BAM().fromBytes(d)
-        if Sanity :
-            d2 = self.bam.toBytes()
-            assert d == d2
+        d = ''.join(str(self.readSector(t, s)) for t,s in self.fmt.bamSecs)
+        self.bam = self.fmt.newBAM().fromBytes(d)
+        if self.verify and self.bam.toBytes() != d :
+            raise Error("BAM does not re-encode to what is on disk")
     def writeBAM(self) :
+        if not self.loaded('bam') :
+            return
         d = self.bam.toBytes()
-        writeSector(self.fn, 18, 0, d)
+        for n,(t,s) in enumerate(self.fmt.bamSecs) :
+            self.writeSector(t, s, d[n*256 : n*256 + 256])
     def sync(self) :
+        """Write out all changes.  Inside a transaction this only stages them for commit()."""
+        self.writeDir()
+        self.writeBAM()
+        if not self.txn :
+            self.flush()
+    def abort(self) :
+        """Throw away all changes since the last sync."""
+        self.dirty = {}
+        self.txn = False
+        self.forget()
+
+    def begin(self) :
+        """
+        Open a transaction.  Changes not yet synced become part of it, so
+        they are journaled by commit() and thrown away by rollback().
+        """
+        if self.txn :
+            raise Error("transaction already open")
+        self.txn = True
+    def rollback(self) :
+        if not self.txn :
+            raise Error("no transaction open")
+        self.abort()
+    def commit(self, whole=False) :
+        """
+        Apply the transaction.  Normally the dirty sectors are journaled
+        and then written in place.  With whole set the updated image is
+        written to a temp file and renamed over the original instead.
+        """
+        if not self.txn :
+            raise Error("no transaction open")
         self.writeDir()
         self.writeBAM()
+        if self.img.atomic :
+            self.flush(durable=True)
+        elif whole :
+            self.replaceImage()
+        elif self.dirty :
+            offs = sorted(self.dirty)
+            orig = []
+            for off in offs :
+                t,s,d = self.dirty[off]
+                orig.append((off, str(self.img.readSector(t, s))))
+            writeJournal(self.fn, orig)
+            self.img.writeSectors([self.dirty[off] for off in offs], durable=True)
+            removeJournal(self.fn)
+        self.dirty = {}
+        self.txn = False
+
+    def replaceImage(self) :
+        dat = bytearray(file(self.fn, 'rb').read())
+        for off,(t,s,d) in self.dirty.items() :
+            dat[off*256 : off*256 + 256] = d
+        tmp = self.fn + '.tmp'
+        f = file(tmp, 'wb')
+        f.write(dat)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.chmod(tmp, os.stat(self.fn).st_mode)
+        self.img.close()
+        os.rename(tmp, self.fn)
+        syncDir(self.fn)
+        self.openImage()
 
     def showBam(self) :
-        for t,b in enumerate(self.bam.bam) :
-            print 'bam %d:' % (t+1), ' '.join(str(n) for n in sorted(b))
+        for t in xrange(1, len(self.bam.bam)+1) :
+            print 'bam %d:' % t, ' '.join(str(n) for n in self.bam.freeSectors(t))
             break # XXX
 
     def readDir(self) :
-        t,s = 18,1
+        """Read the whole directory chain, starting at 18/1 (40/3 on a d81)."""
+        dir = []
+        dirSecs = []
+        t,s = self.fmt.dirStart
         while t != 0 :
-            d = readSector(self.fn, t, s)
-            self.dir = [Dirent().fromBytes(d[n*32 : 32 + n*32]) for n in xrange(8)]
-            t,s = self.dir[0].link
-            assert t == 0 # just one block for now
-            if Sanity :
-                d2 = ''.join(e.toBytes() for e in self.dir)
-                assert d == d2
+            if (t,s) in dirSecs :
+                raise Error("directory chain loops at %d/%d" % (t,s))
+            d = self.readSector(t, s)
+            ents = [Dirent().fromBytes(d[n*32 : 32 + n*32]) for n in xrange(8)]
+            if self.verify and ''.join(e.toBytes() for e in ents) != str(d) :
+                raise Error("directory sector %d/%d does not re-encode to what is on disk" % (t,s))
+            dirSecs.append((t,s))
+            dir += ents
+            t,s = ents[0].link
+        self.dir = dir
+        self.dirSecs = dirSecs
+        self.indexDir()
     def writeDir(self) :
-        assert len(self.dir) == 8
-        d = ''.join(e.toBytes() for e in self.dir)
-        writeSector(self.fn, 18, 1, d)
+        if not self.loaded('dir') :
+            return
+        assert len(self.dir) == 8 * len(self.dirSecs)
+        for n,(t,s) in enumerate(self.dirSecs) :
+            d = ''.join(e.toBytes() for e in self.dir[n*8 : n*8 + 8])
+            self.writeSector(t, s, d)
+
+    def indexDir(self) :
+        """Build the name index and the free entry list from self.dir."""
+        self.names = {}
+        self.freeEnts = []
+        for d in self.dir :
+            if d.typ == 0 :
+                self.freeEnts.append(d)
+            elif d.name not in self.names :
+                self.names[d.name] = d
+        self.freeEnts.reverse() # so pop() hands out the first free slot
+
+    def allocDirSector(self) :
+        t,last = self.dirSecs[-1]
+        t,s = self.alloc.nextDir(self.bam, last)
+        self.bam.allocate(t, s)
+        return t,s
+
+    def growDir(self) :
+        """Add a sector to the end of the directory chain."""
+        t,s = self.allocDirSector()
+        ents = [Dirent().fromBytes('\0' * 32) for n in xrange(8)]
+        ents[0].link = (0, 0xff)
+        self.dir[-8].link = (t,s)
+        self.dirSecs.append((t,s))
+        self.dir += ents
+        self.freeEnts += reversed(ents)
+
+    def newDirent(self, fn) :
+        """Claim a free directory entry for fn, growing the directory if needed."""
+        if not self.freeEnts :
+            self.growDir()
+        d = self.freeEnts.pop()
+        d.name = fn
+        d.side = 0,0
+        d.rlen = 0
+        self.names[fn] = d
+        return d
+
+    def lookup(self, fn) :
+        return self.names.get(fn)
+
+    def renameFile(self, old, new) :
+        d = self.names.get(old)
+        if d is None or new in self.names :
+            return
+        del self.names[old]
+        d.name = new
+        self.names[new] = d
+        return True
  
     def fileSectors(self, loc) :
         t,s = loc
+        n = 0
         while t != 0 :
-            d = readSector(self.fn, t, s)
+            n += 1
+            if n > self.fmt.total :
+                raise Error("sector chain at %d/%d loops" % loc)
+            d = self.readSector(t, s)
             t2,s2 = struct.unpack('<BB', d[0:2])
             if t2 == 0 :
-                sz = s2
+                sz = s2 + 1 # s2 is the index of the last byte used
             else :
                 sz = 256
             #print 'read', t2,s2,sz, d.encode('hex')
@@ -263,68 +1069,463 @@ class Disk(object) :
     def freeSector(self, t, s) :
         #print 'free', t,s
         assert t > 0
-        assert s not in self.bam.bam[t-1]
-        self.bam.bam[t-1].add(s)
+        self.bam.release(t, s)
+
+    def allocSector(self, prev=None) :
+        """Allocate the first sector of a chain, or the one following prev."""
+        if prev is None :
+            t,s = self.alloc.first(self.bam)
+        else :
+            t,s = self.alloc.next(self.bam, *prev)
+        #print 'alloc', t, s
+        self.bam.allocate(t, s)
+        return t,s
 
-    def allocSector(self) :
-        for t,fr in enumerate(self.bam.bam) :
-            if fr :
-                s = fr.pop()
-                #print 'alloc', t+1, s
-                return t+1, s
+    def blocksFree(self) :
+        """Free blocks available to files, which like the DOS leaves out the directory track."""
+        return self.bam.nfree - self.bam.trackFree(self.fmt.dirTrack)
 
     def freeFile(self, loc) :
         for t,s,d in self.fileSectors(loc) :
             self.freeSector(t,s)
+
+    def freeEntry(self, d) :
+        """Free the sectors of a directory entry's file, including REL side sectors."""
+        self.freeFile(d.loc)
+        if d.typ & 7 == 4 and d.side[0] != 0 :
+            self.freeFile(d.side)
             
+    def dropDirent(self, d) :
+        """Return a directory entry to the free list."""
+        del self.names[d.name]
+        d.typ = 0
+        d.name = '\0' * 16
+        self.freeEnts.append(d)
+
     def removeFile(self, fn) :
-        for d in self.dir :
-            if d.name == fn :
-                #self.showBam()
-                self.freeFile(d.loc)
-                #self.showBam()
-                d.typ == 0
-                d.name = '\0' * 16
-                return True
+        d = self.names.get(fn)
+        if d is not None :
+            #self.showBam()
+            self.freeEntry(d)
+            #self.showBam()
+            self.dropDirent(d)
+            return True
 
     def readFile(self, fn) :
-        for d in self.dir :
-            if d.name == fn :
-                dat = ''.join(dat for t,s,dat in self.fileSectors(d.loc))
-                assert len(dat) >= 2
-                addr = struct.unpack("<H", dat[0:2])
-                return addr, dat[2:]
+        d = self.names.get(fn)
+        if d is not None :
+            dat = ''.join(dat for t,s,dat in self.fileSectors(d.loc))
+            assert len(dat) >= 2
+            addr = struct.unpack("<H", dat[0:2])
+            return addr, dat[2:]
+
+    def open(self, fn) :
+        """Return a FileReader for fn, or None if there is no such file."""
+        d = self.names.get(fn)
+        if d is not None :
+            return FileReader(self, d.loc)
+
+    def openRel(self, fn) :
+        """Return a RelFile for record access to REL file fn, or None if there is no such file."""
+        d = self.names.get(fn)
+        if d is not None :
+            if d.typ & 7 != 4 :
+                raise Error("%s is not a REL file" % fn)
+            return RelFile(self, d)
+
+    def createRel(self, fn, rlen) :
+        """
+        Create an empty REL file with records of rlen bytes.  Like the
+        DOS this writes one data block of empty records and its side
+        sector.  Returns a RelFile.
+        """
+        if not 1 <= rlen <= 254 :
+            raise Error("bad record length %d" % rlen)
+        if fn in self.names :
+            raise Error("%s already exists" % fn)
+        d = self.newDirent(fn)
+        d.typ = 0x84
+        d.rlen = rlen
+        d.loc,d.size = (0,0),0
+        r = RelFile(self, d)
+        try :
+            r.grow(0)
+        except Error :
+            self.dropDirent(d)
+            raise
+        return r
 
     def writeData(self, bs) :
-        ours,rest = bs[:254], bs[254:]
-        if rest :
-            (lt,ls),sz = self.writeData(rest)
+        """Write bs to a new sector chain, returning its first sector and its length in sectors."""
+        chunks = [bs[n : n+254] for n in xrange(0, len(bs), 254)] or ['']
+        if len(chunks) > self.blocksFree() :
+            raise Error("disk full")
+        secs = []
+        for dat in chunks :
+            secs.append(self.allocSector(secs[-1] if secs else None))
+        for n,(t,s) in enumerate(secs) :
+            if n+1 < len(secs) :
+                lt,ls = secs[n+1]
+            else :
+                lt,ls = 0, len(chunks[n])+1
+            dat = struct.pack('<BB', lt,ls) + pad(chunks[n], 254, '\0')
+            self.writeSector(t, s, dat)
+        return secs[0], len(secs)
+
+    def putFile(self, fn, bs, typ=0x82) :
+        """Write the raw bytes of a file, replacing any existing file of that name."""
+        d = self.names.get(fn)
+        if d is not None :
+            self.freeEntry(d)
+            d.side,d.rlen = (0,0),0
         else :
-            (lt,ls),sz = (0, len(bs)+2), 0
-        t,s = self.allocSector()
-        dat = struct.pack('<BB', lt,ls) + pad(ours, 254, '\0')
-        writeSector(self.fn, t, s, dat)
-        return (t,s),sz+1
+            d = self.newDirent(fn)
+        try :
+            d.loc,d.size = self.writeData(bs)
+        except Error :
+            self.dropDirent(d)
+            raise
+        d.typ = typ
+        return True
+
+    def getFile(self, fn) :
+        """Return the raw bytes of a file, or None."""
+        r = self.open(fn)
+        if r is not None :
+            return r.read()
 
     def writeFile(self, fn, addr, dat) :
         assert addr < 65536
-        found = None
-        empty = None
+        return self.putFile(fn, struct.pack('<H', addr) + dat)
+
+    def importFiles(self, files) :
+        """
+        Write many files at once from a list of (name, raw bytes, type).
+        Files being replaced are freed first so their space can be reused.
+        Nothing reaches the image until the next sync() or commit().
+        """
+        if len(set(fn for fn,bs,typ in files)) != len(files) :
+            raise Error("duplicate file names")
+        for fn,bs,typ in files :
+            d = self.names.get(fn)
+            if d is not None :
+                self.freeEntry(d)
+                d.loc,d.size = (0,0),0
+                d.side,d.rlen = (0,0),0
+        need = sum(max(1, (len(bs) + 253) // 254) for fn,bs,typ in files)
+        if need > self.blocksFree() :
+            raise Error("disk full: need %d blocks, %d free" % (need, self.blocksFree()))
+        for fn,bs,typ in files :
+            d = self.names.get(fn) or self.newDirent(fn)
+            d.typ = typ
+            d.loc,d.size = self.writeData(bs)
+
+    def exportFiles(self) :
+        """
+        Yield (name, raw bytes, type) for every file in the directory.
+        Entries without a sector chain, such as an empty DEL file, are empty.
+        """
         for d in self.dir :
-            if d.name == fn :
-                found = d
-            if d.typ == 0 :
-                empty = d
-        if found is not None :
-            self.freeFile(found.loc)
+            if d.typ != 0 and self.names.get(d.name) is d :
+                yield d.name, self.getFile(d.name) if d.loc[0] != 0 else '', d.typ
+
+class FileReader(object) :
+    """
+    File-like reader over the bytes of a sector chain (for a PRG this
+    includes the load address).  Data is copied a sector at a time
+    straight into the caller's buffer, and seeking only follows the
+    link bytes of the sectors being skipped.
+    """
+    def __init__(self, disk, loc) :
+        self.disk = disk
+        self.loc = loc
+        self.rewind()
+
+    def rewind(self) :
+        self.load(self.loc)
+        self.base = 0
+        self.off = 0
+        self.nsecs = 1
+
+    def load(self, loc) :
+        t,s = loc
+        self.d = self.disk.readSector(t, s)
+        lt,ls = struct.unpack('<BB', self.d[0:2])
+        if lt == 0 :
+            self.next = None
+            self.n = max(ls - 1, 0)
         else :
-            found = empty
-        if found is not None :
-            d.name = fn
-            d.typ = 0x82
-            bs = struct.pack('<H', addr) + dat
-            d.loc,d.size = self.writeData(bs)
-            return True
+            self.next = lt,ls
+            self.n = 254
+
+    def advance(self) :
+        """Move to the next sector in the chain, returning False at the end."""
+        if self.next is None :
+            return False
+        self.nsecs += 1
+        if self.nsecs > self.disk.fmt.total :
+            raise Error("sector chain at %d/%d loops" % self.loc)
+        self.base += self.n
+        self.load(self.next)
+        self.off = 0
+        return True
+
+    def tell(self) :
+        return self.base + self.off
+
+    def seek(self, pos, whence=0) :
+        if whence == 1 :
+            pos += self.tell()
+        elif whence == 2 :
+            while self.advance() :
+                pass
+            pos += self.base + self.n
+        if pos < 0 :
+            raise Error("negative seek position %d" % pos)
+        if pos < self.base :
+            self.rewind()
+        while pos > self.base + self.n and self.advance() :
+            pass
+        self.off = min(pos - self.base, self.n)
+        return self.tell()
+
+    def readinto(self, buf) :
+        mv = memoryview(buf)
+        got = 0
+        while got < len(mv) :
+            if self.off == self.n and not self.advance() :
+                break
+            k = min(len(mv) - got, self.n - self.off)
+            mv[got : got+k] = self.d[2 + self.off : 2 + self.off + k]
+            self.off += k
+            got += k
+        return got
+
+    def read(self, size=-1) :
+        out = []
+        while size != 0 :
+            if self.off == self.n and not self.advance() :
+                break
+            k = self.n - self.off
+            if size > 0 :
+                k = min(k, size)
+                size -= k
+            out.append(self.d[2 + self.off : 2 + self.off + k])
+            self.off += k
+        return ''.join(out)
+
+    def close(self) :
+        self.d = None
+    def __enter__(self) :
+        return self
+    def __exit__(self, typ, val, tb) :
+        self.close()
+
+class RelFile(object) :
+    """
+    Record access to a REL file.  Its side sectors list every data
+    sector in order, so they are read once on open and record n is then
+    found by arithmetic, costing one or two sector reads without walking
+    the data chain.  Side sector layout:
+         00-01: Track/sector of the next side sector
+            02: Side sector number within its group (0-5)
+            03: Record length
+         04-0F: Track/sector of each side sector in the group
+         10-FF: Track/sector of up to 120 data sectors
+    On a 1581 the directory entry points at a super side sector, $FE in
+    byte 02, listing the first side sector of up to 126 groups from 03.
+    Writes go through the disk's cache, so sync() or commit() as usual.
+    """
+    perSide = 120
+    perGroup = 6
+    emptyRecord = '\xff'
+
+    def __init__(self, disk, d) :
+        self.disk = disk
+        self.ent = d
+        self.rlen = d.rlen
+        if not 1 <= self.rlen <= 254 :
+            raise Error("%s: bad record length %d" % (d.name, self.rlen))
+        self.maxSides = self.perGroup * (126 if disk.fmt.superSide else 1)
+        self.superLoc = None
+        self.sides = []
+        self.data = []
+        self.nrecs = 0
+        if d.side[0] != 0 :
+            self.loadSides()
+
+    def loadSides(self) :
+        t,s = self.ent.side
+        if self.disk.fmt.superSide :
+            d = self.disk.readSector(t, s)
+            if ord(d[2]) != 0xfe :
+                raise Error("%s: no super side sector at %d/%d" % (self.ent.name, t, s))
+            self.superLoc = t,s
+            t,s = ord(d[0]), ord(d[1])
+        while t != 0 :
+            if len(self.sides) == self.maxSides :
+                raise Error("%s: too many side sectors" % self.ent.name)
+            d = self.disk.readSector(t, s)
+            self.sides.append((t,s))
+            lt,ls = ord(d[0]), ord(d[1])
+            end = 256 if lt else ls + 1
+            for n in xrange(16, end - 1, 2) :
+                self.data.append((ord(d[n]), ord(d[n+1])))
+            t,s = lt,ls
+        if not self.data :
+            raise Error("%s: side sectors list no data" % self.ent.name)
+        d = self.disk.readSector(*self.data[-1])
+        if ord(d[0]) != 0 :
+            raise Error("%s: side sectors don't reach the end of the data" % self.ent.name)
+        used = (len(self.data) - 1) * 254 + max(ord(d[1]) - 1, 0)
+        self.nrecs = used // self.rlen
+
+    def __len__(self) :
+        return self.nrecs
+
+    def patch(self, loc, off, bs) :
+        """Overwrite bytes of a sector from offset off."""
+        d = bytearray(str(self.disk.readSector(*loc)))
+        d[off : off + len(bs)] = bs
+        self.disk.writeSector(loc[0], loc[1], str(d))
+
+    def record(self, n) :
+        """The rlen bytes of record n."""
+        if not 0 <= n < self.nrecs :
+            raise Error("%s: no record %d" % (self.ent.name, n))
+        i,off = divmod(n * self.rlen, 254)
+        out = []
+        left = self.rlen
+        while left :
+            k = min(left, 254 - off)
+            d = self.disk.readSector(*self.data[i])
+            out.append(str(d[2 + off : 2 + off + k]))
+            left -= k
+            i,off = i + 1, 0
+        return ''.join(out)
+
+    def setRecord(self, n, bs) :
+        """Write record n, padded with zeros, first extending the file with empty records if need be."""
+        if len(bs) > self.rlen :
+            raise Error("%s: record of %d bytes, record length is %d" % (self.ent.name, len(bs), self.rlen))
+        if n >= self.nrecs :
+            self.grow(n)
+        self.putRecord(n, pad(bs, self.rlen, '\0'))
+
+    def putRecord(self, n, bs) :
+        i,off = divmod(n * self.rlen, 254)
+        while bs :
+            k = min(len(bs), 254 - off)
+            self.patch(self.data[i], 2 + off, bs[:k])
+            bs = bs[k:]
+            i,off = i + 1, 0
+
+    def isEmpty(self, n) :
+        return self.record(n) == pad(self.emptyRecord, self.rlen, '\0')
+
+    def append(self, bs) :
+        """Write bs to the record after the last non-empty one, returning its number."""
+        n = self.nrecs
+        while n > 0 and self.isEmpty(n - 1) :
+            n -= 1
+        self.setRecord(n, bs)
+        return n
+
+    def grow(self, n) :
+        """
+        Extend the file so record n exists.  As on the drive, the new data
+        blocks are filled with as many empty records as fit.
+        """
+        need = -(-(n + 1) * self.rlen // 254)
+        more = max(need - len(self.data), 0)
+        sides = -(-need // self.perSide)
+        if sides > self.maxSides :
+            raise Error("%s: record %d is past the largest possible REL file" % (self.ent.name, n))
+        more += max(sides - len(self.sides), 0)
+        if self.disk.fmt.superSide and self.superLoc is None :
+            more += 1
+        if more > self.disk.blocksFree() :
+            raise Error("disk full")
+        while len(self.data) < need :
+            self.addData()
+        old = self.nrecs
+        self.nrecs = len(self.data) * 254 // self.rlen
+        empty = pad(self.emptyRecord, self.rlen, '\0')
+        for r in xrange(old, self.nrecs) :
+            self.putRecord(r, empty)
+        used = self.nrecs * self.rlen - (len(self.data) - 1) * 254
+        self.patch(self.data[-1], 0, chr(0) + chr(used + 1))
+
+    def addData(self) :
+        """Add a data sector to the end of the file, and to the side sectors."""
+        prev = self.data[-1] if self.data else None
+        t,s = self.disk.allocSector(prev)
+        self.ent.size += 1
+        self.disk.writeSector(t, s, '\0\x01' + '\0' * 254)
+        if prev is None :
+            self.ent.loc = t,s
+        else :
+            self.patch(prev, 0, chr(t) + chr(s))
+        if len(self.data) == self.perSide * len(self.sides) :
+            self.addSide((t,s))
+        i = len(self.data)
+        self.data.append((t,s))
+        pos = 16 + 2 * (i % self.perSide)
+        self.patch(self.sides[-1], 0, chr(0) + chr(pos + 1))
+        self.patch(self.sides[-1], pos, chr(t) + chr(s))
+
+    def allocSide(self, prev) :
+        t,s = self.disk.allocSector(prev)
+        self.ent.size += 1
+        return t,s
+
+    def addSide(self, prev) :
+        """Start a new side sector after sector prev, updating its group in every member."""
+        if self.disk.fmt.superSide and self.superLoc is None :
+            self.superLoc = self.allocSide(prev)
+            self.ent.side = self.superLoc
+            self.disk.writeSector(self.superLoc[0], self.superLoc[1], '\0\0\xfe' + '\0' * 253)
+            prev = self.superLoc
+        n = len(self.sides)
+        t,s = self.allocSide(prev)
+        self.disk.writeSector(t, s, chr(0) + chr(15) + chr(n % self.perGroup) + chr(self.rlen) + '\0' * 252)
+        if self.sides :
+            self.patch(self.sides[-1], 0, chr(t) + chr(s))
+        elif self.superLoc is None :
+            self.ent.side = t,s
+        self.sides.append((t,s))
+        g = n // self.perGroup
+        group = self.sides[g * self.perGroup:]
+        gs = ''.join(chr(gt) + chr(gss) for gt,gss in group)
+        for loc in group :
+            self.patch(loc, 4, gs)
+        if self.superLoc is not None and n % self.perGroup == 0 :
+            if g == 0 :
+                self.patch(self.superLoc, 0, chr(t) + chr(s))
+            self.patch(self.superLoc, 3 + 2*g, chr(t) + chr(s))
+
+def stat(fn) :
+    """
+    (format, disk name, disk id, blocks free) of an image, reading only
+    its BAM.
+    """
+    with Disk(fn, ro=True) as d :
+        return d.fmt, d.bam.name, struct.pack('<H', d.bam.id), d.blocksFree()
+
+def newImage(fn, name, did='00', fmt=d64Format) :
+    """Create a freshly formatted image."""
+    bam = fmt.newBAM().format(name, did)
+    d = Dirent().fromBytes('\0' * 32)
+    d.link = 0,0xff
+    f = file(fn, 'wb')
+    f.write('\0' * fmt.size)
+    dat = bam.toBytes()
+    for n,(t,s) in enumerate(fmt.bamSecs) :
+        f.seek(fmt.offset(t, s) * 256)
+        f.write(dat[n*256 : n*256 + 256])
+    f.seek(fmt.offset(*fmt.dirStart) * 256)
+    f.write(d.toBytes())
+    f.close()
 
 """
 def cmp(xs, ys) :
@@ -337,11 +1538,11 @@ def test() :
     d = Disk('testDisk.d64')
     #print d.bam
     print 'disk', d.bam.name,
-    print '%d sectors free' % sum(len(fr) for fr in d.bam.bam)
+    print '%d sectors free' % d.blocksFree()
     for e in d.dir :
         print ' ', e
     if 0 :
-        d.dir[0].name = 'RENAME'
+        d.renameFile(d.dir[0].name, 'RENAME')
         d.bam.name = 'MYDISK'
         d.sync()
     if 0 :
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+Check d64 (and d71/d81) images for damage.
+
+    fsck64.py [-f] [-j jobs] image-or-dir...
+
+Every directory entry's sector chain is followed once over an mmap of
+the image, marking each sector with its owner, so each sector is looked
+at no more than once.  Reports bad links, chains that loop, sectors
+shared by two chains, block counts that disagree with the chain, and
+sectors whose BAM bit disagrees with the chains.  With -f the BAM is
+rebuilt from the chains and written back.  With -j images are checked
+in a pool of worker processes.
+"""
+import os, sys, getopt, mmap
+from multiprocessing import Pool
+import d64
+from index64 import findImages
+
+class Checker(object) :
+    def __init__(self, fn, fix=False) :
+        self.fn = fn
+        self.fix = fix
+        self.f = file(fn, 'r+b' if fix else 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_WRITE if fix else mmap.ACCESS_READ)
+        try :
+            self.fmt = d64.formatFor(len(self.mm))
+        except d64.Error :
+            self.close()
+            raise
+        self.owner = [None] * self.fmt.total
+        self.owners = []
+        self.problems = []
+
+    def close(self) :
+        self.mm.close()
+        self.f.close()
+
+    def sector(self, t, s) :
+        return buffer(self.mm, self.fmt.offset(t, s) * 256, 256)
+
+    def problem(self, msg) :
+        self.problems.append(msg)
+
+    def claim(self, who, t, s) :
+        """Mark a sector as belonging to owner number who.  False if it already belonged to someone."""
+        off = self.fmt.offset(t, s)
+        prev = self.owner[off]
+        if prev is None :
+            self.owner[off] = who
+            return True
+        if prev == who :
+            self.problem('%s: chain loops back to %d/%d' % (self.owners[who], t, s))
+        else :
+            self.problem('%s: sector %d/%d is cross-linked with %s' % (self.owners[who], t, s, self.owners[prev]))
+        return False
+
+    def valid(self, t, s) :
+        return 1 <= t <= self.fmt.tracks and s < self.fmt.spt[t]
+
+    def walk(self, who, loc) :
+        """Follow a chain from loc, claiming its sectors.  Returns the number of sectors claimed."""
+        t,s = loc
+        n = 0
+        while t != 0 :
+            if not self.valid(t, s) :
+                self.problem('%s: bad link to %d/%d' % (self.owners[who], t, s))
+                break
+            if not self.claim(who, t, s) :
+                break
+            n += 1
+            d = self.sector(t, s)
+            t,s = ord(d[0]), ord(d[1])
+            if t == 0 and s < 1 :
+                self.problem('%s: bad last byte index %d' % (self.owners[who], s))
+        return n
+
+    def newOwner(self, name) :
+        self.owners.append(name)
+        return len(self.owners) - 1
+
+    def checkDir(self) :
+        who = self.newOwner('directory')
+        ents = []
+        t,s = self.fmt.dirStart
+        while t != 0 :
+            if not self.valid(t, s) :
+                self.problem('directory: bad link to %d/%d' % (t, s))
+                break
+            if not self.claim(who, t, s) :
+                break
+            d = self.sector(t, s)
+            ents += [d64.Dirent().fromBytes(d[n*32 : n*32 + 32]) for n in xrange(8)]
+            t,s = ents[-8].link
+        return ents
+
+    def checkFiles(self, ents) :
+        for n,e in enumerate(ents) :
+            if e.typ == 0 or e.loc[0] == 0 :
+                continue
+            who = self.newOwner('entry %d %r' % (n, e.name))
+            cnt = self.walk(who, e.loc)
+            if e.typ & 7 == 4 and e.side[0] != 0 :
+                cnt += self.walk(who, e.side)
+            if cnt != e.size :
+                self.problem('%s: directory says %d blocks, chain has %d' % (self.owners[who], e.size, cnt))
+
+    def checkBAM(self) :
+        """Compare the BAM with the chains, returning a BAM rebuilt from the chains."""
+        bs = ''.join(str(self.sector(t, s)) for t,s in self.fmt.bamSecs)
+        bam = self.fmt.newBAM()
+        want = []
+        for t,(fr,bits) in enumerate(bam.rawEntries(bs), 1) :
+            if fr != d64.bitCount(bits) :
+                self.problem('bam: track %d free count %d, bitmap has %d' % (t, fr, d64.bitCount(bits)))
+            w = 0
+            for s in xrange(self.fmt.spt[t]) :
+                who = self.owner[self.fmt.offset(t, s)]
+                free = (bits >> s) & 1
+                if t in self.fmt.sysTracks :
+                    if free :
+                        self.problem('bam: %d/%d is reserved but marked free' % (t, s))
+                elif who is None :
+                    w |= 1 << s
+                    if not free :
+                        self.problem('bam: %d/%d is marked used but nothing uses it' % (t, s))
+                elif free :
+                    self.problem('bam: %d/%d is used by %s but marked free' % (t, s, self.owners[who]))
+            want.append(w)
+        bam.header(bs)
+        bam.bam = want
+        bam.counts = [d64.bitCount(bits) for bits in want]
+        return bam
+
+    def writeBAM(self, bam) :
+        d = bam.toBytes()
+        for n,(t,s) in enumerate(self.fmt.bamSecs) :
+            off = self.fmt.offset(t, s) * 256
+            self.mm[off : off + 256] = d[n*256 : n*256 + 256]
+        self.mm.flush()
+
+    def check(self) :
+        who = self.newOwner('bam')
+        for t,s in self.fmt.bamSecs :
+            self.claim(who, t, s)
+        self.checkFiles(self.checkDir())
+        bam = self.checkBAM()
+        fixed = False
+        if self.fix and any(p.startswith('bam:') for p in self.problems) :
+            self.writeBAM(bam)
+            fixed = True
+        return self.problems, fixed
+
+def checkImage(args) :
+    fn,fix = args
+    try :
+        c = Checker(fn, fix)
+        try :
+            return (fn,) + c.check()
+        finally :
+            c.close()
+    except Exception, e :
+        return fn, ['cannot check: %s: %s' % (e.__class__.__name__, e)], False
+
+def main() :
+    opts,args = getopt.getopt(sys.argv[1:], 'fj:')
+    opts = dict(opts)
+    if not args :
+        print __doc__
+        sys.exit(1)
+    fix = '-f' in opts
+    fns = []
+    for a in args :
+        if os.path.isdir(a) :
+            fns += sorted(findImages([a]))
+        else :
+            fns.append(a)
+    todo = [(fn, fix) for fn in fns]
+    if '-j' in opts :
+        pool = Pool(int(opts['-j']))
+        results = pool.imap(checkImage, todo, chunksize=16)
+    else :
+        results = (checkImage(x) for x in todo)
+
+    bad = 0
+    for fn,problems,fixed in results :
+        if not problems :
+            continue
+        bad += 1
+        print '%s: %d problems%s' % (fn, len(problems), ', BAM rebuilt' if fixed else '')
+        for p in problems :
+            print '   ', p
+    print '%d images checked, %d with problems' % (len(fns), bad)
+    sys.exit(1 if bad else 0)
+
+if __name__ == '__main__' :
+    main()
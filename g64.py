@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+Convert between d64 images and g64 raw GCR track images.
+
+    g64.py encode image.d64 out.g64
+    g64.py decode image.g64 out.d64
+
+See http://unusedino.de/ec64/technical/formats/g64.html
+
+Each sector is written as the 1541 writes it: a sync, the GCR encoded
+header block ($08, checksum, sector, track, id2, id1, $0F, $0F), a
+header gap, another sync and the data block ($07, 256 bytes, checksum,
+$00, $00), followed by a gap.  GCR coding goes four bytes to five at a
+time through lookup tables.  Decoding finds syncs at any bit position,
+so tracks that don't keep to byte boundaries still read.
+
+If the d64 has error info bytes the matching errors are written into
+the GCR (bad checksums, missing syncs and so on), and decoding a g64
+produces error info for every sector that doesn't read cleanly.
+"""
+import sys, re, struct, binascii
+import d64
+
+gcr = [0x0a, 0x0b, 0x12, 0x13, 0x0e, 0x0f, 0x16, 0x17,
+       0x09, 0x19, 0x1a, 0x1b, 0x0d, 0x1d, 0x1e, 0x15]
+
+# byte => 10 GCR bits, and 10 GCR bits => byte or -1
+encTab = [(gcr[b >> 4] << 5) | gcr[b & 15] for b in xrange(256)]
+decTab = [-1] * 1024
+for b,g in enumerate(encTab) :
+    decTab[g] = b
+
+signature = 'GCR-1541'
+maxTrackSize = 7928
+halfTracks = 84
+trackCapacity = {3: 7692, 2: 7142, 1: 6666, 0: 6250}
+syncMark = '\xff' * 5
+headerGap = '\x55' * 9
+
+# d64 error info codes, and the DOS errors they stand for
+errOK = 0x01
+errNoHeader = 0x02       # 20 READ ERROR, header block not found
+errNoSync = 0x03         # 21 READ ERROR, no sync
+errNoData = 0x04         # 22 READ ERROR, data block not found
+errChecksum = 0x05       # 23 READ ERROR, data block checksum
+errHeaderChecksum = 0x09 # 27 READ ERROR, header block checksum
+errID = 0x0b             # 29 DISK ID MISMATCH
+
+def speedZone(t) :
+    if t <= 17 :
+        return 3
+    if t <= 24 :
+        return 2
+    if t <= 30 :
+        return 1
+    return 0
+
+def encode(bs) :
+    """GCR encode a string whose length is a multiple of 4."""
+    n = len(bs) // 4
+    vals = []
+    for a,b,c,d in zip(*[iter(bytearray(bs))] * 4) :
+        v = (encTab[a] << 30) | (encTab[b] << 20) | (encTab[c] << 10) | encTab[d]
+        vals += (v >> 32, v & 0xffffffff)
+    return struct.pack('>' + 'BI' * n, *vals)
+
+def decode(gs) :
+    """Decode a GCR string whose length is a multiple of 5, raising Error on invalid codes."""
+    n = len(gs) // 5
+    vals = struct.unpack('>' + 'BI' * n, gs)
+    out = []
+    for i in xrange(0, 2*n, 2) :
+        v = (vals[i] << 32) | vals[i+1]
+        out += (decTab[v >> 30], decTab[(v >> 20) & 1023], decTab[(v >> 10) & 1023], decTab[v & 1023])
+    try :
+        return bytearray(out)
+    except ValueError :
+        raise d64.Error("invalid GCR code")
+
+def xor(bs) :
+    x = 0
+    for b in bytearray(bs) :
+        x ^= b
+    return x
+
+def encodeSector(t, s, did, data, err=errOK) :
+    """GCR for one sector, header sync to the end of the data block, with an optional error."""
+    id1,id2 = ord(did[0]), ord(did[1])
+    if err == errID :
+        id1 ^= 0xff
+    ck = s ^ t ^ id2 ^ id1
+    if err == errHeaderChecksum :
+        ck ^= 0xff
+    hdr = struct.pack('BBBBBBBB', 0x00 if err == errNoHeader else 0x08, ck, s, t, id2, id1, 0x0f, 0x0f)
+    ck = xor(data)
+    if err == errChecksum :
+        ck ^= 0xff
+    blk = chr(0x00 if err == errNoData else 0x07) + str(data) + chr(ck) + '\0\0'
+    sync = '\x55' * 5 if err == errNoSync else syncMark
+    return sync + encode(hdr) + headerGap + sync + encode(blk)
+
+def encodeTrack(t, did, secs, errs=None) :
+    """GCR for a whole track from its sectors' data, padded with gaps to the track's capacity."""
+    cap = trackCapacity[speedZone(t)]
+    parts = [encodeSector(t, s, did, d, errs[s] if errs else errOK) for s,d in enumerate(secs)]
+    gap = (cap - sum(len(p) for p in parts)) // len(parts)
+    if gap < 0 :
+        raise d64.Error("track %d doesn't fit in %d bytes" % (t, cap))
+    raw = ('\x55' * gap).join(parts)
+    return raw + '\x55' * (cap - len(raw))
+
+syncRe = re.compile('1{10,}')
+
+def bits(raw) :
+    """A string of '0' and '1' for the bits of raw."""
+    if not raw :
+        return ''
+    return bin(int(binascii.hexlify(raw), 16))[2:].zfill(len(raw) * 8)
+
+def unbits(bs) :
+    n = len(bs) // 8
+    return binascii.unhexlify('%0*x' % (2*n, int(bs[:8*n], 2)))
+
+def decodeTrack(t, raw, did=None) :
+    """
+    Decode the sectors of a raw track.  Returns {sector: (data, error)},
+    where data is None when there was no readable data block.  With did
+    set, headers for another disk ID are reported as ID mismatches.
+    """
+    bs = bits(raw)
+    n = len(bs)
+    # the track is a loop: append enough of its start to finish a block that wraps
+    ring = bs + bs[:(10 + 325 + 20) * 8]
+    found = {}
+    hdr = None
+    for m in syncRe.finditer(ring) :
+        if m.start() >= n and hdr is None :
+            break
+        pos = m.end()
+        if pos + 80 > len(ring) :
+            break
+        try :
+            blk = decode(unbits(ring[pos : pos + 80]))
+        except d64.Error :
+            hdr = None
+            continue
+        if blk[0] == 0x08 :
+            if m.start() >= n :
+                break
+            ck,s,ht,id2,id1 = blk[1:6]
+            err = errOK
+            if ck != s ^ ht ^ id2 ^ id1 :
+                err = errHeaderChecksum
+            elif did is not None and chr(id1) + chr(id2) != did :
+                err = errID
+            hdr = (s, err) if ht == t else None
+        elif hdr is not None :
+            s,err = hdr
+            hdr = None
+            if blk[0] != 0x07 :
+                found.setdefault(s, (None, errNoData))
+                continue
+            if pos + 325*8 > len(ring) :
+                break
+            try :
+                blk = decode(unbits(ring[pos : pos + 325*8]))
+            except d64.Error :
+                found.setdefault(s, (None, errChecksum))
+                continue
+            data = str(blk[1:257])
+            if err == errOK and xor(data) != blk[257] :
+                err = errChecksum
+            if s not in found or found[s][1] != errOK :
+                found[s] = data, err
+    return found
+
+class G64(object) :
+    """
+    Bytes: 00-07: "GCR-1541"
+              08: Version ($00)
+              09: Number of half tracks (usually 84)
+           0A-0B: Maximum track size
+    Then a table of 4 byte offsets to each half track's data (0 if there
+    is none), a table of 4 byte speed zones, and the track data, each a
+    2 byte length followed by the raw GCR padded to the maximum size.
+    """
+    def __init__(self) :
+        self.ntracks = halfTracks
+        self.maxSize = maxTrackSize
+        self.tracks = {}   # half track index (0 is track 1) => raw GCR
+        self.speeds = {}
+
+    def fromBytes(self, bs) :
+        if bs[:8] != signature :
+            raise d64.Error("not a g64 image")
+        ver,self.ntracks,self.maxSize = struct.unpack('<BBH', bs[8:12])
+        offs = struct.unpack('<%dI' % self.ntracks, bs[12 : 12 + 4*self.ntracks])
+        speeds = struct.unpack('<%dI' % self.ntracks, bs[12 + 4*self.ntracks : 12 + 8*self.ntracks])
+        for i,off in enumerate(offs) :
+            if off :
+                n, = struct.unpack('<H', bs[off : off + 2])
+                self.tracks[i] = bs[off + 2 : off + 2 + n]
+                self.speeds[i] = speeds[i]
+        return self
+
+    def toBytes(self) :
+        offs = []
+        data = []
+        pos = 12 + 8*self.ntracks
+        for i in xrange(self.ntracks) :
+            if i in self.tracks :
+                raw = self.tracks[i]
+                offs.append(pos)
+                data.append(struct.pack('<H', len(raw)) + d64.pad(raw, self.maxSize, '\0'))
+                pos += 2 + self.maxSize
+            else :
+                offs.append(0)
+        speeds = [self.speeds.get(i, 0) for i in xrange(self.ntracks)]
+        hdr = signature + struct.pack('<BBH', 0, self.ntracks, self.maxSize)
+        return hdr + struct.pack('<%dI' % self.ntracks, *offs) + struct.pack('<%dI' % self.ntracks, *speeds) + ''.join(data)
+
+    def track(self, t) :
+        return self.tracks.get(2 * (t-1))
+
+    def setTrack(self, t, raw) :
+        if len(raw) > self.maxSize :
+            raise d64.Error("track %d is %d bytes, more than %d" % (t, len(raw), self.maxSize))
+        self.tracks[2 * (t-1)] = raw
+        self.speeds[2 * (t-1)] = speedZone(t)
+
+def errorInfo(disk) :
+    """The error info bytes of a Disk, raw or packed, or None if it has none."""
+    errs = disk.img.tail()[:disk.fmt.total]
+    if len(errs) == disk.fmt.total :
+        return bytearray(errs)
+
+def fromDisk(disk, errs=None) :
+    """Build a G64 from a 1541 format Disk, with optional error info bytes."""
+    fmt = disk.fmt
+    if fmt not in (d64.d64Format, d64.d64x40Format) :
+        raise d64.Error("g64 images are for 1541 disks, not %s" % fmt.name)
+    did = struct.pack('<H', disk.bam.id)
+    g = G64()
+    for t in xrange(1, fmt.tracks + 1) :
+        secs = [disk.readSector(t, s) for s in xrange(fmt.spt[t])]
+        terrs = None
+        if errs is not None :
+            base = fmt.offset(t, 0)
+            terrs = errs[base : base + fmt.spt[t]]
+        g.setTrack(t, encodeTrack(t, did, secs, terrs))
+    return g
+
+def toImage(g, fn) :
+    """
+    Write the sectors of a G64 to a d64 (40 tracks if the g64 has data
+    there), adding error info if any sector didn't read cleanly.
+    Returns the number of bad sectors.
+    """
+    fmt = d64.d64x40Format if g.track(36) else d64.d64Format
+    found18 = decodeTrack(18, g.track(18) or '')
+    did = None
+    if 0 in found18 and found18[0][0] is not None :
+        did = found18[0][0][0xa2 : 0xa4]
+    dat = bytearray(fmt.size)
+    errs = bytearray([errOK]) * fmt.total
+    for t in xrange(1, fmt.tracks + 1) :
+        raw = g.track(t)
+        found = decodeTrack(t, raw, did) if raw else {}
+        for s in xrange(fmt.spt[t]) :
+            off = fmt.offset(t, s)
+            if not raw :
+                errs[off] = errNoSync
+                continue
+            data,err = found.get(s, (None, errNoHeader))
+            if data is not None :
+                dat[off*256 : off*256 + 256] = data
+            errs[off] = err
+    bad = sum(1 for e in errs if e != errOK)
+    f = file(fn, 'wb')
+    f.write(dat)
+    if bad :
+        f.write(errs)
+    f.close()
+    return bad
+
+def main() :
+    if len(sys.argv) != 4 or sys.argv[1] not in ('encode', 'decode') :
+        print __doc__
+        sys.exit(1)
+    cmd,src,dst = sys.argv[1:]
+    try :
+        if cmd == 'encode' :
+            with d64.Disk(src, ro=True) as d :
+                g = fromDisk(d, errorInfo(d))
+            f = file(dst, 'wb')
+            f.write(g.toBytes())
+            f.close()
+        else :
+            g = G64().fromBytes(file(src, 'rb').read())
+            bad = toImage(g, dst)
+            if bad :
+                print '%s: %d sectors with errors' % (src, bad)
+    except d64.Error, e :
+        print 'error:', e
+        sys.exit(1)
+
+if __name__ == '__main__' :
+    main()
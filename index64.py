@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Catalog a tree of d64 (and d71/d81) images into an SQLite index.
+
+    index64.py [-j jobs] index.db dir...     (re)index images under dirs
+    index64.py -f name index.db              find files by name
+    index64.py -s sha1 index.db              find files by content hash
+
+Images are parsed in a process pool.  Only images whose mtime or size
+changed since the last run are read again, and images that have gone
+away are dropped from the index.
+"""
+import os, sys, getopt, hashlib, sqlite3, struct
+from multiprocessing import Pool
+import d64
+
+schema = """
+create table if not exists images (
+    path text primary key,
+    mtime real,
+    size integer,
+    name text,
+    id text,
+    free integer,
+    error text
+);
+create table if not exists files (
+    path text,
+    slot integer,
+    name text,
+    typ integer,
+    blocks integer,
+    length integer,
+    sha1 text
+);
+create index if not exists files_path on files(path);
+create index if not exists files_name on files(name);
+create index if not exists files_sha1 on files(sha1);
+"""
+
+def text(s) :
+    """PETSCII bytes to something sqlite will store as text."""
+    return s.decode('latin-1')
+
+def scanImage(args) :
+    """Parse one image.  Runs in a pool worker, so it only deals in plain data."""
+    path,mtime,size = args
+    try :
+        with d64.Disk(path, mm=True, ro=True) as d :
+            ents = []
+            for slot,e in enumerate(d.dir) :
+                if e.typ == 0 :
+                    continue
+                if e.loc[0] == 0 :
+                    # DEL or zero length entries have no chain: no data, no hash
+                    ents.append((slot, e.name, e.typ, e.size, 0, None))
+                    continue
+                h = hashlib.sha1()
+                n = 0
+                r = d64.FileReader(d, e.loc)
+                while True :
+                    buf = r.read(4096)
+                    if not buf :
+                        break
+                    h.update(buf)
+                    n += len(buf)
+                ents.append((slot, e.name, e.typ, e.size, n, h.hexdigest()))
+            did = struct.pack('<H', d.bam.id)
+            return path, mtime, size, d.bam.name, did, d.blocksFree(), ents, None
+    except Exception, e :
+        return path, mtime, size, '', '', 0, [], '%s: %s' % (e.__class__.__name__, e)
+
+def findImages(dirs) :
+    for top in dirs :
+        for dn,subdirs,fns in os.walk(top) :
+            for fn in fns :
+                if os.path.splitext(fn)[1].lower() in ('.d64', '.d71', '.d81') :
+                    yield os.path.join(dn, fn)
+
+def store(db, r) :
+    path,mtime,size,name,did,free,ents,err = r
+    path = text(path)
+    db.execute("delete from files where path = ?", (path,))
+    db.execute("insert or replace into images values (?,?,?,?,?,?,?)",
+        (path, mtime, size, text(name), text(did), free, err))
+    db.executemany("insert into files values (?,?,?,?,?,?,?)",
+        [(path, slot, text(nm), typ, blocks, n, sha) for slot,nm,typ,blocks,n,sha in ents])
+
+def index(dbfn, dirs, jobs=None) :
+    db = sqlite3.connect(dbfn)
+    db.executescript(schema)
+    known = dict((p, (m, s)) for p,m,s in db.execute("select path, mtime, size from images"))
+
+    todo = []
+    seen = set()
+    for fn in findImages(dirs) :
+        st = os.stat(fn)
+        key = text(fn)
+        seen.add(key)
+        if known.get(key) != (st.st_mtime, st.st_size) :
+            todo.append((fn, st.st_mtime, st.st_size))
+
+    gone = [p for p in known if p not in seen]
+    for p in gone :
+        db.execute("delete from files where path = ?", (p,))
+        db.execute("delete from images where path = ?", (p,))
+
+    errs = 0
+    if todo :
+        pool = Pool(jobs)
+        for n,r in enumerate(pool.imap_unordered(scanImage, todo, chunksize=16)) :
+            store(db, r)
+            if r[-1] is not None :
+                errs += 1
+            if n % 1000 == 999 :
+                db.commit()
+        pool.close()
+        pool.join()
+    db.commit()
+    db.close()
+    print '%d images indexed, %d unchanged, %d removed, %d errors' % (len(todo), len(seen) - len(todo), len(gone), errs)
+
+def find(dbfn, col, val) :
+    db = sqlite3.connect(dbfn)
+    q = "select f.path, i.name, f.name, f.typ, f.blocks, f.sha1 from files f join images i on f.path = i.path where f.%s = ? order by f.path" % col
+    for path,dname,name,typ,blocks,sha in db.execute(q, (text(val),)) :
+        print '%s [%s] %r %s %d blocks %s' % (path, dname, name.encode('latin-1'), d64.typExt.get(0x80 | (typ & 7), '?'), blocks, sha)
+    db.close()
+
+def main() :
+    opts,args = getopt.getopt(sys.argv[1:], 'j:f:s:')
+    opts = dict(opts)
+    if '-f' in opts and len(args) == 1 :
+        find(args[0], 'name', opts['-f'])
+    elif '-s' in opts and len(args) == 1 :
+        find(args[0], 'sha1', opts['-s'])
+    elif len(args) >= 2 :
+        jobs = int(opts['-j']) if '-j' in opts else None
+        index(args[0], args[1:], jobs)
+    else :
+        print __doc__
+        sys.exit(1)
+
+if __name__ == '__main__' :
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Link 6502 object files.
+
+    ld64.py [-b base] [-o out.prg] [-m] module.s|module.o...
+
+Sources are assembled to module.o first, but only when the object is
+missing or older than the source, so a rebuild only reassembles the
+modules that changed; objects can also be given directly, such as a
+library of routines assembled once.  Fixed sections go where their
+"* =" put them and the other sections follow each other, in the order
+the modules were given, from base (by default the end of the last
+fixed section).  Labels are global across modules, except those starting
+with _, which are local to the module defining them.  Writes a PRG file
+(load address, then the bytes) with -o and a map of the global symbols
+with -m.
+"""
+import os, sys, getopt, time
+import asm
+
+class LinkError(Exception) :
+    pass
+
+def build(fn) :
+    """The object for a source or object file, assembling the source if its object is out of date."""
+    if fn.endswith('.o') :
+        return asm.loadObject(fn), False
+    ofn = asm.objName(fn)
+    if os.path.exists(ofn) and os.path.getmtime(ofn) >= os.path.getmtime(fn) :
+        try :
+            return asm.loadObject(ofn), False
+        except asm.AsmError :
+            pass
+    prog = asm.parseFile(fn)
+    o = prog is not None and asm.asmObject(prog)
+    if not o :
+        raise LinkError("%s did not assemble" % fn)
+    asm.saveObject(ofn, o)
+    return o, True
+
+def place(objs, base=None) :
+    """{(module, section): address} for every section."""
+    addrs = {}
+    end = None
+    for m,o in enumerate(objs) :
+        for s,(org,bs) in enumerate(o['sections']) :
+            if org is not None :
+                addrs[m,s] = org
+                if bs and (end is None or org + len(bs) > end) :
+                    end = org + len(bs)
+    if base is None :
+        base = end
+    if base is None and any(bs for o in objs for org,bs in o['sections'] if org is None) :
+        raise LinkError("no base address for placed sections: give -b or a * = in a module")
+    dot = base or 0
+    for m,o in enumerate(objs) :
+        for s,(org,bs) in enumerate(o['sections']) :
+            if org is None :
+                addrs[m,s] = dot
+                dot += len(bs)
+    return addrs
+
+def symbols(objs, names, addrs) :
+    """The global symbols, and each module's local ones."""
+    syms = {}
+    local = [{} for o in objs]
+    where = {}
+    for m,o in enumerate(objs) :
+        for name,(s,off) in o['symbols'].items() :
+            if asm.isLocal(name) :
+                local[m][name] = addrs[m,s] + off
+                continue
+            if name in syms :
+                raise LinkError("%s is defined in %s and %s" % (name, where[name], names[m]))
+            syms[name] = addrs[m,s] + off
+            where[name] = names[m]
+    return syms, local
+
+def link(objs, names, base=None) :
+    """
+    Link objects, named by names for messages.  Returns ((base address,
+    bytes), global symbols), the result being as asm.asm returns.
+    """
+    addrs = place(objs, base)
+    syms,local = symbols(objs, names, addrs)
+    secs = []
+    for m,o in enumerate(objs) :
+        sbs = [bytearray(bs) for org,bs in o['sections']]
+        for s,off,kind,name in o['relocs'] :
+            table = local[m] if asm.isLocal(name) else syms
+            if name not in table :
+                raise LinkError("%s: undefined symbol %s" % (names[m], name))
+            v = table[name]
+            if kind == 'word' :
+                sbs[s][off : off + 2] = bytearray([v & 0xff, v >> 8])
+            elif kind == 'byte' :
+                if v > 255 :
+                    raise LinkError("%s: %s is $%04x, too big for a byte" % (names[m], name, v))
+                sbs[s][off] = v
+            else :
+                d = v - (addrs[m,s] + off + 1)
+                if not -128 <= d <= 127 :
+                    raise LinkError("%s: branch to %s is out of range" % (names[m], name))
+                sbs[s][off] = d & 0xff
+        secs += [(addrs[m,s], bs, names[m]) for s,bs in enumerate(sbs) if bs]
+    if not secs :
+        return (None, []), syms
+
+    secs.sort()
+    out = bytearray()
+    start = secs[0][0]
+    prev = None
+    for addr,bs,name in secs :
+        if addr + len(bs) > 0x10000 :
+            raise LinkError("%s: section at $%04x runs past $ffff" % (name, addr))
+        if start + len(out) > addr :
+            raise LinkError("%s: section at $%04x overlaps %s" % (name, addr, prev))
+        out += bytearray(addr - start - len(out))
+        out += bs
+        prev = name
+    return (start, list(out)), syms
+
+def main() :
+    opts,args = getopt.getopt(sys.argv[1:], 'b:o:m')
+    opts = dict(opts)
+    if not args :
+        print __doc__
+        sys.exit(1)
+    base = int(opts['-b'], 0) if '-b' in opts else None
+    try :
+        t = time.time()
+        objs = []
+        for fn in args :
+            o,built = build(fn)
+            if built :
+                print 'assembled', fn
+            objs.append(o)
+        t1 = time.time()
+        (start,bs),syms = link(objs, args, base)
+        t2 = time.time()
+    except (LinkError, asm.AsmError), e :
+        print 'error:', e
+        sys.exit(1)
+    if start is None :
+        print 'nothing to link'
+        sys.exit(1)
+    print '%04x-%04x: %d bytes, %d modules (load %.3fs, link %.3fs)' % (start, start + len(bs), len(bs), len(objs), t1 - t, t2 - t1)
+    if '-m' in opts :
+        for name,v in sorted(syms.items(), key=lambda x : (x[1], x[0])) :
+            print '%04x %s' % (v, name)
+    if '-o' in opts :
+        f = file(opts['-o'], 'wb')
+        f.write(chr(start & 0xff) + chr(start >> 8) + ''.join(chr(b) for b in bs))
+        f.close()
+
+if __name__ == '__main__' :
+    main()
@@ -0,0 +1,302 @@
+"""
+Peephole optimiser for parsed 6502 programs, run by asm between parsing
+and assembly when asked to.
+
+    store-load   sta x / lda x             => sta x
+    jmp-rts      jmp l ... l: rts          => rts
+    branch-jmp   bcc l / jmp m / l:        => bcs m
+    dead-code    jmp/rts/rti then lines up to the next label are dropped
+    inc-dec      lda x / clc / adc #1 / sta x => inc x  (and sec/sbc/dec)
+
+A rewrite is only made where the registers and flags it changes aren't
+used afterwards, found by following the code (through branches and
+jumps to labels) until they are all overwritten; a jsr, rts or anything
+else that can't be followed counts as a use.  Rewritten and removed lines
+become blank lines, so line numbers are kept.  Accesses to the addresses
+in `unsafe` are left alone: on a C64 the processor port at $00-$01 and
+the I/O at $d000-$dfff don't read back what was written, and a store to
+$a000-$bfff or $e000-$ffff goes to the RAM under the ROM a load reads.
+Change `unsafe` for other memory maps.  inc-dec assumes decimal mode is
+off, and dead-code that nothing jumps into except through a label.
+"""
+import asm
+from asm import Val, opTab, cycles
+
+# registers and flags each instruction reads and writes
+effects = {
+    'lda': ('', 'ANZ'), 'ldx': ('', 'XNZ'), 'ldy': ('', 'YNZ'),
+    'sta': ('A', ''), 'stx': ('X', ''), 'sty': ('Y', ''),
+    'tax': ('A', 'XNZ'), 'tay': ('A', 'YNZ'), 'txa': ('X', 'ANZ'), 'tya': ('Y', 'ANZ'),
+    'tsx': ('', 'XNZ'), 'txs': ('X', ''),
+    'pha': ('A', ''), 'php': ('NZCV', ''), 'pla': ('', 'ANZ'), 'plp': ('', 'NZCV'),
+    'ora': ('A', 'ANZ'), 'and': ('A', 'ANZ'), 'eor': ('A', 'ANZ'), 'bit': ('A', 'NZV'),
+    'adc': ('AC', 'ANZCV'), 'sbc': ('AC', 'ANZCV'),
+    'cmp': ('A', 'NZC'), 'cpx': ('X', 'NZC'), 'cpy': ('Y', 'NZC'),
+    'asl': ('A', 'ANZC'), 'lsr': ('A', 'ANZC'), 'rol': ('AC', 'ANZC'), 'ror': ('AC', 'ANZC'),
+    'inc': ('', 'NZ'), 'dec': ('', 'NZ'),
+    'inx': ('X', 'XNZ'), 'dex': ('X', 'XNZ'), 'iny': ('Y', 'YNZ'), 'dey': ('Y', 'YNZ'),
+    'clc': ('', 'C'), 'sec': ('', 'C'), 'clv': ('', 'V'),
+    'cli': ('', ''), 'sei': ('', ''), 'cld': ('', ''), 'sed': ('', ''), 'nop': ('', ''),
+    'bpl': ('N', ''), 'bmi': ('N', ''), 'bvc': ('V', ''), 'bvs': ('V', ''),
+    'bcc': ('C', ''), 'bcs': ('C', ''), 'bne': ('Z', ''), 'beq': ('Z', ''),
+    'jmp': ('', ''), 'jsr': ('', ''), 'rts': ('', ''), 'rti': ('', ''), 'brk': ('', ''),
+}
+inverse = {'bcc': 'bcs', 'bcs': 'bcc', 'bne': 'beq', 'beq': 'bne',
+           'bpl': 'bmi', 'bmi': 'bpl', 'bvc': 'bvs', 'bvs': 'bvc'}
+loads = {'sta': 'lda', 'stx': 'ldx', 'sty': 'ldy'}
+# address ranges where a load may not read back what was stored
+unsafe = [
+    (0x0000, 0x0001),   # 6510 processor port
+    (0xa000, 0xbfff),   # BASIC ROM over RAM
+    (0xd000, 0xdfff),   # I/O
+    (0xe000, 0xffff),   # KERNAL ROM over RAM
+]
+maxScan = 200       # instructions followed looking for a use before giving up
+
+def effect(l) :
+    """(read, written) sets of registers and flags for an op line."""
+    r,w = effects[l.op]
+    mode = l.arg.typ
+    if mode != 'A' and l.op in ('asl', 'lsr', 'rol', 'ror') :
+        r,w = r.replace('A', ''), w.replace('A', '')
+    if mode in ('abs,X', 'zpg,X', 'X,ind') :
+        r += 'X'
+    elif mode in ('abs,Y', 'zpg,Y', 'ind,Y') :
+        r += 'Y'
+    return set(r), set(w)
+
+def argKey(a) :
+    v = getattr(a, 'val', None)
+    if v is None :
+        return a.typ,
+    return a.typ, v.typ, v.val if v.typ == 'int' else v.name
+
+def isUnsafe(a) :
+    v = getattr(a, 'val', None)
+    return v is not None and v.typ == 'int' and any(lo <= v.val <= hi for lo,hi in unsafe)
+
+def blank() :
+    return Val(None)
+
+def op(name, arg) :
+    assert (name, arg.typ) in opTab
+    return Val("op", op=name, arg=arg)
+
+def cost(ls) :
+    """(bytes, cycles) of the op lines in ls."""
+    k = [(l.op, l.arg.typ) for l in ls if l.typ == 'op']
+    return sum(opTab[x][1] for x in k), sum(cycles[x] for x in k)
+
+class Prog(object) :
+    """A program being optimised, with its labels and the address of every line."""
+    def __init__(self, p) :
+        self.p = p
+        self.labels = dict((l.var, i) for i,l in enumerate(p) if l.typ == 'setvar')
+        modes = [l.arg.typ if l.typ == 'op' else None for l in p]
+        syms = asm.layout(p, modes, {})
+        self.dots = []
+        dot = 0
+        for l in p :
+            if l.typ == 'setdot' :
+                dot = asm.peekNum(syms, l.val) or 0
+            self.dots.append(dot)
+            if l.typ == 'op' :
+                dot += opTab[l.op, l.arg.typ][1]
+        # every address the program names as a number
+        self.fixed = set(l.arg.val.val for l in p if l.typ == 'op' and getattr(l.arg, 'val', None) is not None and l.arg.val.typ == 'int')
+
+    def nextOp(self, i) :
+        """The index of the first op line after i, and whether a label or origin comes before it."""
+        marked = False
+        for j in xrange(i + 1, len(self.p)) :
+            l = self.p[j]
+            if l.typ == 'op' :
+                return j, marked
+            if l.typ is not None :
+                marked = True
+        return None, marked
+
+    def target(self, l) :
+        """The line index of a jump or branch's label, or None if it isn't a label."""
+        v = l.arg.val
+        if v.typ == 'var' :
+            return self.labels.get(v.name)
+
+    def dead(self, start, regs) :
+        """True if none of regs can be read, starting at line start, before being written."""
+        todo = [(start, set(regs))]
+        seen = {}
+        steps = 0
+        while todo :
+            i,regs = todo.pop()
+            while regs :
+                if i is None or i >= len(self.p) :
+                    return False
+                if i in seen and regs <= seen[i] :
+                    break
+                seen[i] = seen.get(i, set()) | regs
+                l = self.p[i]
+                if l.typ == 'setdot' :
+                    return False
+                if l.typ != 'op' :
+                    i += 1
+                    continue
+                steps += 1
+                if steps > maxScan :
+                    return False
+                r,w = effect(l)
+                if regs & r :
+                    return False
+                regs = regs - w
+                if not regs :
+                    break
+                if l.op in ('jsr', 'rts', 'rti', 'brk') :
+                    return False
+                if l.op == 'jmp' :
+                    if l.arg.typ != 'abs' :
+                        return False
+                    i = self.target(l)
+                    continue
+                if l.arg.typ == 'rel' :
+                    t = self.target(l)
+                    if t is None :
+                        return False
+                    todo.append((t, regs))
+                i += 1
+        return True
+
+# Each rule looks at line i and returns None or (edits, cycles saved),
+# edits being (line index, new line) pairs.
+
+def storeLoad(pr, i) :
+    p = pr.p
+    l = p[i]
+    if l.op not in loads or isUnsafe(l.arg) :
+        return
+    j,marked = pr.nextOp(i)
+    if j is None or marked or p[j].op != loads[l.op] or argKey(p[j].arg) != argKey(l.arg) :
+        return
+    if pr.dead(j + 1, 'NZ') :
+        return [(j, blank())], cost([p[j]])[1]
+
+def jmpRts(pr, i) :
+    p = pr.p
+    l = p[i]
+    if l.op != 'jmp' or l.arg.typ != 'abs' :
+        return
+    t = pr.target(l)
+    if t is None :
+        return
+    j = t
+    while j < len(p) and p[j].typ in (None, 'setvar') :
+        j += 1
+    if j < len(p) and p[j].typ == 'op' and p[j].op == 'rts' :
+        return [(i, op('rts', Val("impl")))], cost([l])[1]
+
+def branchJmp(pr, i) :
+    p = pr.p
+    l = p[i]
+    if l.op not in inverse :
+        return
+    j,marked = pr.nextOp(i)
+    if j is None or marked or p[j].op != 'jmp' or p[j].arg.typ != 'abs' :
+        return
+    skip = pr.target(l)
+    if skip is None or not j < skip or any(p[k].typ not in (None, 'setvar') for k in xrange(j + 1, skip)) :
+        return
+    t = pr.target(p[j])
+    if t is None :
+        return
+    lo,hi = min(i, t), max(j, t)
+    if any(p[k].typ == 'setdot' for k in xrange(lo, hi + 1)) :
+        return
+    # code only gets shorter, so distances on the current layout are the most they can be
+    dest = pr.dots[t]
+    if dest > pr.dots[i] :
+        off = dest - pr.dots[j] - 3
+    else :
+        off = dest - (pr.dots[i] + 2)
+    if not -128 <= off <= 127 :
+        return
+    new = op(inverse[l.op], Val("rel", val=p[j].arg.val))
+    return [(i, new), (j, blank())], cost([l, p[j]])[1] - cost([new])[1]
+
+def deadCode(pr, i) :
+    p = pr.p
+    l = p[i]
+    if l.op not in ('jmp', 'rts', 'rti') :
+        return
+    edits = []
+    for j in xrange(i + 1, len(p)) :
+        if p[j].typ in ('setvar', 'setdot') :
+            break
+        if p[j].typ == 'op' :
+            if pr.dots[j] in pr.fixed :
+                return
+            edits.append((j, blank()))
+    if edits :
+        return edits, 0
+
+def incDec(pr, i) :
+    p = pr.p
+    l = p[i]
+    if l.op != 'lda' or isUnsafe(l.arg) or ('inc', l.arg.typ) not in opTab :
+        return
+    seq = [i]
+    for n in xrange(3) :
+        j,marked = pr.nextOp(seq[-1])
+        if j is None or marked :
+            return
+        seq.append(j)
+    c,a,s = [p[k] for k in seq[1:]]
+    if (c.op, a.op) == ('clc', 'adc') :
+        name = 'inc'
+    elif (c.op, a.op) == ('sec', 'sbc') :
+        name = 'dec'
+    else :
+        return
+    if a.arg.typ != '#' or argKey(a.arg) != ('#', 'int', 1) or s.op != 'sta' or argKey(s.arg) != argKey(l.arg) :
+        return
+    if not pr.dead(seq[-1] + 1, 'ACV') :
+        return
+    new = op(name, l.arg)
+    return [(i, new)] + [(k, blank()) for k in seq[1:]], cost([p[k] for k in seq])[1] - cost([new])[1]
+
+rules = [
+    ('store-load', storeLoad),
+    ('jmp-rts', jmpRts),
+    ('branch-jmp', branchJmp),
+    ('dead-code', deadCode),
+    ('inc-dec', incDec),
+]
+
+def optimise(prog, stats=None) :
+    """
+    Return an optimised copy of a parsed program.  If stats is a dict
+    it gets {rule: (rewrites, bytes saved, cycles saved once through)}
+    under 'peep'.
+    """
+    p = list(prog)
+    found = dict((name, [0, 0, 0]) for name,rule in rules)
+    changed = True
+    while changed :
+        changed = False
+        pr = Prog(p)
+        for name,rule in rules :
+            for i in xrange(len(p)) :
+                if p[i].typ != 'op' :
+                    continue
+                r = rule(pr, i)
+                if r is None :
+                    continue
+                edits,saved = r
+                f = found[name]
+                f[0] += 1
+                f[1] += cost([p[k] for k,v in edits])[0] - cost([v for k,v in edits])[0]
+                f[2] += saved
+                for k,v in edits :
+                    p[k] = v
+                changed = True
+    if stats is not None :
+        stats['peep'] = dict((name, tuple(f)) for name,f in found.items())
+    return p
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Profile an assembled 6502 program in the simulator.
+
+    prof6502.py [-l cycle-limit] [-n top] [-a] prog.s
+
+Assembles prog.s, calls it at its first address and charges the cycles
+and instruction count of everything it runs to the source line that
+assembled it, and to the label that line falls under.  Prints the
+hottest lines and the labels by cycles, and with -a the whole source
+annotated with cycles and counts.  Code run outside the program (such
+as ROM routines it calls) is charged to "?".
+"""
+import sys, getopt
+import asm, sim6502
+
+class Profile(object) :
+    """
+    Assemble a source file and keep what is needed to charge addresses
+    to its lines: the address to line map and the label of every line.
+    """
+    def __init__(self, fn) :
+        self.fn = fn
+        self.src = file(fn).read().split('\n')
+        prog = asm.parseFile(fn)
+        if prog is None :
+            raise sim6502.SimError("%s did not parse" % fn)
+        self.addrs = {}
+        r = asm.asmProg(prog, addrs=self.addrs)
+        if r is None :
+            raise sim6502.SimError("%s did not assemble" % fn)
+        self.base,self.bytes = r
+        self.label = [None]
+        cur = None
+        for l in prog :
+            if l.typ == 'setvar' :
+                cur = l.var
+            self.label.append(cur)
+        self.cycles = {}    # address => cycles
+        self.counts = {}    # address => instructions run
+
+    def trace(self, pc, n) :
+        self.cycles[pc] = self.cycles.get(pc, 0) + n
+        self.counts[pc] = self.counts.get(pc, 0) + 1
+
+    def run(self, cpu=None, limit=None) :
+        """Load the program into cpu (a new CPU if None) and call it.  Returns the cycles taken."""
+        cpu = cpu or sim6502.CPU()
+        cpu.load(self.base, self.bytes)
+        return cpu.call(self.base, limit, self.trace)
+
+    def byLine(self) :
+        """{line number or None: (cycles, count)}"""
+        lines = {}
+        for pc,n in self.cycles.items() :
+            lno = self.addrs.get(pc)
+            c,k = lines.get(lno, (0, 0))
+            lines[lno] = c + n, k + self.counts[pc]
+        return lines
+
+    def byLabel(self) :
+        """{label: (cycles, count)}, with None for lines before the first label and '?' for code outside the program."""
+        labels = {}
+        for lno,(n,k) in self.byLine().items() :
+            lab = self.label[lno] if lno is not None else '?'
+            c,kk = labels.get(lab, (0, 0))
+            labels[lab] = c + n, kk + k
+        return labels
+
+    def report(self, top=20, annotate=False) :
+        total = sum(self.cycles.values())
+        lines = self.byLine()
+        print '%8s %6s %8s  %5s  %s' % ('cycles', '%', 'count', 'line', 'source')
+        for lno,(n,k) in sorted(lines.items(), key=lambda x : -x[1][0])[:top] :
+            src = self.src[lno-1].strip() if lno is not None else '?'
+            print '%8d %6.2f %8d  %5s  %s' % (n, 100.0 * n / max(total, 1), k, lno or '?', src)
+        print
+        print '%8s %6s %8s  %s' % ('cycles', '%', 'count', 'label')
+        for lab,(n,k) in sorted(self.byLabel().items(), key=lambda x : -x[1][0]) :
+            print '%8d %6.2f %8d  %s' % (n, 100.0 * n / max(total, 1), k, lab or '(start)')
+        if annotate :
+            print
+            for lno,l in enumerate(self.src, 1) :
+                if lno in lines :
+                    print '%8d %8d  %5d: %s' % (lines[lno] + (lno, l))
+                else :
+                    print '%8s %8s  %5d: %s' % ('', '', lno, l)
+
+def main() :
+    opts,args = getopt.getopt(sys.argv[1:], 'l:n:a')
+    opts = dict(opts)
+    if len(args) != 1 :
+        print __doc__
+        sys.exit(1)
+    limit = int(opts['-l']) if '-l' in opts else None
+    try :
+        p = Profile(args[0])
+        n = p.run(limit=limit)
+    except sim6502.SimError, e :
+        print 'error:', e
+        sys.exit(1)
+    print '%s: %d cycles' % (args[0], n)
+    p.report(int(opts.get('-n', 20)), '-a' in opts)
+
+if __name__ == '__main__' :
+    main()
@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+"""
+6502 simulator with cycle accurate instruction timing.
+
+    sim6502.py [-l cycle-limit] prog.s
+
+Assembles prog.s, calls it as a subroutine at its first address and
+prints the cycles and instructions it took and the registers it left.
+
+Instructions are decoded with the assembler's opTab run in reverse and
+timed with its cycle table, plus a cycle when indexing crosses a page on
+a read, and one for a taken branch (two if it lands on another page).
+Decimal mode follows the NMOS 6502.  Only the documented opcodes exist;
+anything else raises SimError.
+"""
+import sys, getopt
+import asm
+
+class SimError(Exception) :
+    pass
+
+# opcode => (opname, addrmode, size, base cycles, page cross penalty)
+decTab = [None] * 256
+for (op,mode),(opnum,sz) in asm.opTab.items() :
+    decTab[opnum] = op, mode, sz, asm.cycles[op,mode], (op,mode) in asm.pageCross
+
+retAddr = 0xffff    # call() returns here
+
+def signed8(b) :
+    return b - 256 if b & 0x80 else b
+
+class CPU(object) :
+    """
+    Registers a, x, y, s, pc and the flags n, v, d, i, z, c (each 0 or
+    1), over 64K of RAM in mem.  cycles and insns count what has run.
+    Subclasses can override read and write to map in I/O.
+    """
+    def __init__(self) :
+        self.mem = bytearray(65536)
+        self.a = self.x = self.y = 0
+        self.s = 0xff
+        self.pc = 0
+        self.n = self.v = self.d = self.z = self.c = 0
+        self.i = 1
+        self.cycles = 0
+        self.insns = 0
+        self.ops = [None] * 256
+        for opnum,ent in enumerate(decTab) :
+            if ent is not None :
+                op,mode,sz,cyc,cross = ent
+                self.ops[opnum] = getattr(self, 'op_' + op), mode, sz, cyc, cross
+
+    def load(self, base, bs) :
+        self.mem[base : base + len(bs)] = bytearray(bs)
+
+    def read(self, a) :
+        return self.mem[a]
+
+    def write(self, a, v) :
+        self.mem[a] = v
+
+    def word(self, a) :
+        return self.read(a) | (self.read((a + 1) & 0xffff) << 8)
+
+    def zpWord(self, a) :
+        return self.read(a) | (self.read((a + 1) & 0xff) << 8)
+
+    def push(self, v) :
+        self.write(0x100 | self.s, v)
+        self.s = (self.s - 1) & 0xff
+
+    def pull(self) :
+        self.s = (self.s + 1) & 0xff
+        return self.read(0x100 | self.s)
+
+    def getP(self) :
+        return (self.n << 7) | (self.v << 6) | 0x20 | (self.d << 3) | (self.i << 2) | (self.z << 1) | self.c
+
+    def setP(self, p) :
+        self.n,self.v,self.d,self.i,self.z,self.c = [(p >> b) & 1 for b in (7, 6, 3, 2, 1, 0)]
+
+    p = property(getP, setP)
+
+    def nz(self, v) :
+        self.n = v >> 7
+        self.z = int(v == 0)
+        return v
+
+    def address(self, mode, pc) :
+        """The effective address for an addressing mode and whether indexing crossed a page."""
+        if mode in ('impl', 'A') :
+            return None, False
+        if mode == '#' :
+            return (pc + 1) & 0xffff, False
+        b = self.read((pc + 1) & 0xffff)
+        if mode == 'zpg' :
+            return b, False
+        if mode == 'zpg,X' :
+            return (b + self.x) & 0xff, False
+        if mode == 'zpg,Y' :
+            return (b + self.y) & 0xff, False
+        if mode == 'rel' :
+            return (pc + 2 + signed8(b)) & 0xffff, False
+        if mode == 'X,ind' :
+            return self.zpWord((b + self.x) & 0xff), False
+        if mode == 'ind,Y' :
+            base = self.zpWord(b)
+        else :
+            base = b | (self.read((pc + 2) & 0xffff) << 8)
+            if mode == 'abs' :
+                return base, False
+            if mode == 'ind' :
+                # the NMOS bug: the pointer's high byte comes from the same page
+                return self.read(base) | (self.read((base & 0xff00) | ((base + 1) & 0xff)) << 8), False
+            if mode == 'abs,X' :
+                ea = (base + self.x) & 0xffff
+                return ea, (ea ^ base) & 0xff00 != 0
+        ea = (base + self.y) & 0xffff
+        return ea, (ea ^ base) & 0xff00 != 0
+
+    def step(self) :
+        """Run one instruction, returning the cycles it took."""
+        pc = self.pc
+        opnum = self.read(pc)
+        ent = self.ops[opnum]
+        if ent is None :
+            raise SimError("illegal opcode $%02x at $%04x" % (opnum, pc))
+        fn,mode,sz,cyc,cross = ent
+        ea,crossed = self.address(mode, pc)
+        self.pc = (pc + sz) & 0xffff
+        extra = fn(ea) or 0
+        if cross and crossed :
+            extra += 1
+        self.cycles += cyc + extra
+        self.insns += 1
+        return cyc + extra
+
+    def run(self, pc, stop, limit=None, trace=None) :
+        """
+        Run from pc until pc reaches stop, raising SimError if that takes
+        more than limit cycles.  If trace is set it is called with the
+        address and cycles of every instruction run.
+        """
+        self.pc = pc
+        start = self.cycles
+        while self.pc != stop :
+            at = self.pc
+            n = self.step()
+            if trace is not None :
+                trace(at, n)
+            if limit is not None and self.cycles - start > limit :
+                raise SimError("still running after %d cycles, at $%04x" % (limit, self.pc))
+        return self.cycles - start
+
+    def call(self, addr, limit=None, trace=None) :
+        """Call addr as a subroutine and run until it returns.  Returns the cycles taken, including the jsr."""
+        ret = (retAddr - 1) & 0xffff
+        self.push(ret >> 8)
+        self.push(ret & 0xff)
+        return self.run(addr, retAddr, limit, trace) + asm.cycles['jsr','abs']
+
+    # loads, stores and transfers
+
+    def op_lda(self, ea) :
+        self.a = self.nz(self.read(ea))
+
+    def op_ldx(self, ea) :
+        self.x = self.nz(self.read(ea))
+
+    def op_ldy(self, ea) :
+        self.y = self.nz(self.read(ea))
+
+    def op_sta(self, ea) :
+        self.write(ea, self.a)
+
+    def op_stx(self, ea) :
+        self.write(ea, self.x)
+
+    def op_sty(self, ea) :
+        self.write(ea, self.y)
+
+    def op_tax(self, ea) :
+        self.x = self.nz(self.a)
+
+    def op_tay(self, ea) :
+        self.y = self.nz(self.a)
+
+    def op_txa(self, ea) :
+        self.a = self.nz(self.x)
+
+    def op_tya(self, ea) :
+        self.a = self.nz(self.y)
+
+    def op_tsx(self, ea) :
+        self.x = self.nz(self.s)
+
+    def op_txs(self, ea) :
+        self.s = self.x
+
+    def op_pha(self, ea) :
+        self.push(self.a)
+
+    def op_php(self, ea) :
+        self.push(self.p | 0x10)
+
+    def op_pla(self, ea) :
+        self.a = self.nz(self.pull())
+
+    def op_plp(self, ea) :
+        self.p = self.pull()
+
+    # arithmetic and logic
+
+    def op_ora(self, ea) :
+        self.a = self.nz(self.a | self.read(ea))
+
+    def op_and(self, ea) :
+        self.a = self.nz(self.a & self.read(ea))
+
+    def op_eor(self, ea) :
+        self.a = self.nz(self.a ^ self.read(ea))
+
+    def op_bit(self, ea) :
+        m = self.read(ea)
+        self.z = int(self.a & m == 0)
+        self.n = m >> 7
+        self.v = (m >> 6) & 1
+
+    def op_adc(self, ea) :
+        a,m = self.a, self.read(ea)
+        t = a + m + self.c
+        if not self.d :
+            self.v = (~(a ^ m) & (a ^ t) & 0x80) >> 7
+            self.c = t >> 8
+            self.a = self.nz(t & 0xff)
+            return
+        # Z comes from the binary sum, N and V from the high digit before it is adjusted
+        self.z = int(t & 0xff == 0)
+        lo = (a & 15) + (m & 15) + self.c
+        if lo > 9 :
+            lo += 6
+        hi = (a >> 4) + (m >> 4) + (lo > 15)
+        self.n = (hi >> 3) & 1
+        self.v = (~(a ^ m) & (a ^ (hi << 4)) & 0x80) >> 7
+        if hi > 9 :
+            hi += 6
+        self.c = int(hi > 15)
+        self.a = ((hi << 4) | (lo & 15)) & 0xff
+
+    def op_sbc(self, ea) :
+        a,m = self.a, self.read(ea)
+        borrow = 1 - self.c
+        t = a - m - borrow
+        # the flags are those of the binary subtraction, even in decimal mode
+        self.v = ((a ^ m) & (a ^ t) & 0x80) >> 7
+        self.c = int(t >= 0)
+        r = self.nz(t & 0xff)
+        if self.d :
+            lo = (a & 15) - (m & 15) - borrow
+            hi = (a >> 4) - (m >> 4)
+            if lo < 0 :
+                lo -= 6
+                hi -= 1
+            if hi < 0 :
+                hi -= 6
+            r = ((hi << 4) | (lo & 15)) & 0xff
+        self.a = r
+
+    def compare(self, r, ea) :
+        t = r - self.read(ea)
+        self.c = int(t >= 0)
+        self.nz(t & 0xff)
+
+    def op_cmp(self, ea) :
+        self.compare(self.a, ea)
+
+    def op_cpx(self, ea) :
+        self.compare(self.x, ea)
+
+    def op_cpy(self, ea) :
+        self.compare(self.y, ea)
+
+    # read-modify-write; ea is None for the accumulator forms
+
+    def modify(self, ea, f) :
+        if ea is None :
+            self.a = self.nz(f(self.a))
+        else :
+            self.write(ea, self.nz(f(self.read(ea))))
+
+    def shiftLeft(self, v, bit0) :
+        self.c = v >> 7
+        return ((v << 1) | bit0) & 0xff
+
+    def shiftRight(self, v, bit7) :
+        self.c = v & 1
+        return (v >> 1) | (bit7 << 7)
+
+    def op_asl(self, ea) :
+        self.modify(ea, lambda v : self.shiftLeft(v, 0))
+
+    def op_rol(self, ea) :
+        c = self.c
+        self.modify(ea, lambda v : self.shiftLeft(v, c))
+
+    def op_lsr(self, ea) :
+        self.modify(ea, lambda v : self.shiftRight(v, 0))
+
+    def op_ror(self, ea) :
+        c = self.c
+        self.modify(ea, lambda v : self.shiftRight(v, c))
+
+    def op_inc(self, ea) :
+        self.modify(ea, lambda v : (v + 1) & 0xff)
+
+    def op_dec(self, ea) :
+        self.modify(ea, lambda v : (v - 1) & 0xff)
+
+    def op_inx(self, ea) :
+        self.x = self.nz((self.x + 1) & 0xff)
+
+    def op_iny(self, ea) :
+        self.y = self.nz((self.y + 1) & 0xff)
+
+    def op_dex(self, ea) :
+        self.x = self.nz((self.x - 1) & 0xff)
+
+    def op_dey(self, ea) :
+        self.y = self.nz((self.y - 1) & 0xff)
+
+    # flags
+
+    def op_clc(self, ea) :
+        self.c = 0
+
+    def op_sec(self, ea) :
+        self.c = 1
+
+    def op_cli(self, ea) :
+        self.i = 0
+
+    def op_sei(self, ea) :
+        self.i = 1
+
+    def op_cld(self, ea) :
+        self.d = 0
+
+    def op_sed(self, ea) :
+        self.d = 1
+
+    def op_clv(self, ea) :
+        self.v = 0
+
+    # control flow; self.pc already points past the instruction
+
+    def branch(self, cond, ea) :
+        """Take a branch if cond, returning the extra cycles."""
+        if not cond :
+            return 0
+        extra = 1 if (self.pc ^ ea) & 0xff00 == 0 else 2
+        self.pc = ea
+        return extra
+
+    def op_bpl(self, ea) :
+        return self.branch(not self.n, ea)
+
+    def op_bmi(self, ea) :
+        return self.branch(self.n, ea)
+
+    def op_bvc(self, ea) :
+        return self.branch(not self.v, ea)
+
+    def op_bvs(self, ea) :
+        return self.branch(self.v, ea)
+
+    def op_bcc(self, ea) :
+        return self.branch(not self.c, ea)
+
+    def op_bcs(self, ea) :
+        return self.branch(self.c, ea)
+
+    def op_bne(self, ea) :
+        return self.branch(not self.z, ea)
+
+    def op_beq(self, ea) :
+        return self.branch(self.z, ea)
+
+    def op_jmp(self, ea) :
+        self.pc = ea
+
+    def op_jsr(self, ea) :
+        ret = (self.pc - 1) & 0xffff
+        self.push(ret >> 8)
+        self.push(ret & 0xff)
+        self.pc = ea
+
+    def op_rts(self, ea) :
+        lo = self.pull()
+        self.pc = ((self.pull() << 8 | lo) + 1) & 0xffff
+
+    def op_brk(self, ea) :
+        ret = (self.pc + 1) & 0xffff
+        self.push(ret >> 8)
+        self.push(ret & 0xff)
+        self.push(self.p | 0x10)
+        self.i = 1
+        self.pc = self.word(0xfffe)
+
+    def op_rti(self, ea) :
+        self.p = self.pull()
+        lo = self.pull()
+        self.pc = self.pull() << 8 | lo
+
+    def op_nop(self, ea) :
+        pass
+
+def assemble(fn, cpu=None) :
+    """Assemble fn into a CPU (a new one if cpu is None).  Returns (cpu, base address)."""
+    r = asm.asm(fn)
+    if r is None :
+        raise SimError("%s did not assemble" % fn)
+    base,bs = r
+    cpu = cpu or CPU()
+    cpu.load(base, bs)
+    return cpu, base
+
+def main() :
+    opts,args = getopt.getopt(sys.argv[1:], 'l:')
+    opts = dict(opts)
+    if len(args) != 1 :
+        print __doc__
+        sys.exit(1)
+    limit = int(opts['-l']) if '-l' in opts else None
+    try :
+        cpu,base = assemble(args[0])
+        n = cpu.call(base, limit)
+    except SimError, e :
+        print 'error:', e
+        sys.exit(1)
+    print '%d cycles, %d instructions' % (n, cpu.insns)
+    print 'a=%02x x=%02x y=%02x s=%02x p=%02x' % (cpu.a, cpu.x, cpu.y, cpu.s, cpu.p)
+
+if __name__ == '__main__' :
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Whole-image statistics for d64 collections, using NumPy.
+
+    stats64.py image-or-dir...
+
+An image is loaded as an (nsectors, 256) uint8 array and a batch of
+images of the same format as one (nimages, nsectors, 256) array, so
+link graphs, BAM bitmaps and per sector statistics are computed with
+array operations across the whole batch instead of sector by sector.
+"""
+import os, sys
+import numpy as np
+import d64
+from index64 import findImages
+
+def layout(fmt) :
+    """
+    Return (offs, trackOf, secOf) for a format: offs is a (tracks+1, maxSecs)
+    table of sector offsets (-1 where there is no sector) and trackOf/secOf
+    give the track and sector of every sector offset.
+    """
+    offs = np.array(fmt.offs, dtype=np.intp).reshape(fmt.tracks + 1, fmt.maxSecs)
+    trackOf,secOf = np.nonzero(offs >= 0)   # row major, so in offset order
+    return offs, trackOf, secOf
+
+def load(fn, fmt=None) :
+    """Load one image as an (nsectors, 256) array, dropping any error bytes."""
+    fmt = fmt or d64.imageFormat(fn)
+    if d64.isPacked(fn) :
+        return np.frombuffer(d64.unpackImage(fn), dtype=np.uint8, count=fmt.size).reshape(fmt.total, 256)
+    return np.fromfile(fn, dtype=np.uint8, count=fmt.size).reshape(fmt.total, 256)
+
+def loadMany(fns, fmt) :
+    """Load images of one format as an (nimages, nsectors, 256) array."""
+    imgs = np.empty((len(fns), fmt.total, 256), dtype=np.uint8)
+    for n,fn in enumerate(fns) :
+        imgs[n] = load(fn, fmt)
+    return imgs
+
+def batch(imgs) :
+    if imgs.ndim == 2 :
+        return imgs[np.newaxis]
+    return imgs
+
+def links(imgs, fmt) :
+    """
+    Link graph: for every sector the offset of the sector its first two
+    bytes point at, -1 for end of chain (track 0) and -2 for a link to a
+    sector that doesn't exist.
+    """
+    imgs = batch(imgs)
+    offs,trackOf,secOf = layout(fmt)
+    lt = imgs[:, :, 0].astype(np.intp)
+    ls = imgs[:, :, 1].astype(np.intp)
+    nxt = np.full(lt.shape, -2, dtype=np.intp)
+    ok = (lt >= 1) & (lt <= fmt.tracks) & (ls < fmt.maxSecs)
+    nxt[ok] = offs[lt[ok], ls[ok]]
+    nxt[ok & (nxt < 0)] = -2
+    nxt[lt == 0] = -1
+    return nxt
+
+def unpackBits(b) :
+    """Little endian bits of the last axis of a uint8 array."""
+    bits = np.unpackbits(b[..., np.newaxis], axis=-1)[..., ::-1]
+    return bits.reshape(b.shape[:-1] + (b.shape[-1] * 8,))
+
+def freeMap(imgs, fmt) :
+    """(nimages, nsectors) bool array, True where the BAM says a sector is free."""
+    imgs = batch(imgs)
+    offs,trackOf,secOf = layout(fmt)
+    if fmt.bamClass is d64.BAM :
+        bam = imgs[:, offs[fmt.bamSecs[0]], :]
+        ents = bam[:, 4 : 4 + 4*35].reshape(-1, 35, 4)
+        if fmt.tracks == 40 :
+            # DOLPHIN DOS entries if there are any, otherwise SPEED DOS
+            dolphin = bam[:, 0xac : 0xac + 20].any(axis=1)
+            ext = np.where(dolphin[:, np.newaxis], bam[:, 0xac : 0xac + 20], bam[:, 0xc0 : 0xc0 + 20])
+            ents = np.concatenate([ents, ext.reshape(-1, 5, 4)], axis=1)
+        bits = unpackBits(ents[:, :, 1:])
+    else :
+        # other BAM layouts: one small parse per image, no sector loops
+        bits = np.zeros((len(imgs), fmt.tracks, fmt.maxSecs), dtype=np.uint8)
+        rows = [offs[t, s] for t,s in fmt.bamSecs]
+        for n in xrange(len(imgs)) :
+            ents = fmt.newBAM().rawEntries(imgs[n, rows].tobytes())
+            for t,(fr,b) in enumerate(ents) :
+                bits[n, t] = [(b >> s) & 1 for s in xrange(fmt.maxSecs)]
+    return bits[:, trackOf - 1, secOf].astype(bool)
+
+def empty(imgs) :
+    """(nimages, nsectors) bool array of sectors that are all zero."""
+    return ~batch(imgs).any(axis=2)
+
+def entropy(counts) :
+    """Shannon entropy in bits per byte along the last axis of a histogram."""
+    tot = counts.sum(axis=-1, keepdims=True).astype(np.float64)
+    p = counts / np.maximum(tot, 1)
+    with np.errstate(divide='ignore', invalid='ignore') :
+        h = -np.where(p > 0, p * np.log2(p), 0.0)
+    return h.sum(axis=-1)
+
+def trackEntropy(imgs, fmt, chunk=64) :
+    """(nimages, tracks) entropy of the bytes on each track, a chunk of images at a time."""
+    imgs = batch(imgs)
+    offs,trackOf,secOf = layout(fmt)
+    n = len(imgs)
+    out = np.empty((n, fmt.tracks))
+    for a in xrange(0, n, chunk) :
+        part = imgs[a : a + chunk]
+        m = len(part)
+        row = (np.arange(m)[:, np.newaxis] * fmt.tracks + (trackOf - 1)[np.newaxis, :]) * 256
+        idx = row[:, :, np.newaxis] + part
+        counts = np.bincount(idx.ravel(), minlength=m * fmt.tracks * 256)
+        out[a : a + m] = entropy(counts.reshape(m, fmt.tracks, 256))
+    return out
+
+def sectorEntropy(imgs, chunk=64) :
+    """(nimages, nsectors) entropy of each sector, a chunk of images at a time."""
+    imgs = batch(imgs)
+    n,nsec = imgs.shape[:2]
+    out = np.empty((n, nsec))
+    for a in xrange(0, n, chunk) :
+        part = imgs[a : a + chunk]
+        m = len(part)
+        idx = (np.arange(m * nsec).reshape(m, nsec, 1) * 256) + part
+        counts = np.bincount(idx.ravel(), minlength=m * nsec * 256)
+        out[a : a + m] = entropy(counts.reshape(m, nsec, 256))
+    return out
+
+def fragmentation(imgs, fmt) :
+    """
+    Per image: (links followed, links that change track, mean tracks
+    stepped per track change), over the links of sectors the BAM marks used.
+    """
+    imgs = batch(imgs)
+    offs,trackOf,secOf = layout(fmt)
+    nxt = links(imgs, fmt)
+    used = ~freeMap(imgs, fmt)
+    live = used & (nxt >= 0)
+    step = np.abs(trackOf[np.maximum(nxt, 0)] - trackOf[np.newaxis, :])
+    jumps = live & (step > 0)
+    nlinks = live.sum(axis=1)
+    njumps = jumps.sum(axis=1)
+    mean = np.where(njumps > 0, (step * jumps).sum(axis=1) / np.maximum(njumps, 1).astype(np.float64), 0.0)
+    return nlinks, njumps, mean
+
+def heatmap(imgs, fmt) :
+    """(tracks+1, maxSecs) count of images using each sector, -1 where there is no sector."""
+    offs,trackOf,secOf = layout(fmt)
+    used = (~freeMap(imgs, fmt)).sum(axis=0)
+    hm = np.full(offs.shape, -1, dtype=np.intp)
+    hm[trackOf, secOf] = used
+    return hm
+
+def report(fmt, fns) :
+    imgs = loadMany(fns, fmt)
+    n = len(imgs)
+    free = freeMap(imgs, fmt)
+    emp = empty(imgs)
+    nlinks,njumps,mean = fragmentation(imgs, fmt)
+    th = trackEntropy(imgs, fmt)
+    print '%s: %d images' % (fmt.name, n)
+    print '  used sectors per image: %.1f' % (~free).sum(axis=1).mean()
+    print '  used but all zero: %.1f, free but not zero: %.1f' % ((~free & emp).sum(axis=1).mean(), (free & ~emp).sum(axis=1).mean())
+    print '  links %.1f, track changes %.1f, mean step %.2f tracks' % (nlinks.mean(), njumps.mean(), mean.mean())
+    print '  entropy by track:', ' '.join('%d:%.1f' % (t+1, h) for t,h in enumerate(th.mean(axis=0)))
+    hm = heatmap(imgs, fmt)
+    shades = ' .:-=+*#%@'
+    print '  usage heatmap (track: sectors)'
+    for t in xrange(1, fmt.tracks + 1) :
+        row = hm[t, :fmt.spt[t]]
+        print '  %2d: %s' % (t, ''.join(shades[min(9, int(9.0 * u / n + 0.999))] for u in row))
+
+def main() :
+    if len(sys.argv) < 2 :
+        print __doc__
+        sys.exit(1)
+    fns = []
+    for a in sys.argv[1:] :
+        if os.path.isdir(a) :
+            fns += sorted(findImages([a]))
+        else :
+            fns.append(a)
+    groups = {}
+    for fn in fns :
+        try :
+            fmt = d64.imageFormat(fn)
+        except d64.Error, e :
+            print '%s: %s' % (fn, e)
+            continue
+        groups.setdefault(fmt, []).append(fn)
+    for fmt in d64.formats :
+        if fmt in groups :
+            report(fmt, groups[fmt])
+
+if __name__ == '__main__' :
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+Content-addressed store for d64 images.
+
+    store64.py add store.db image...        add images to the store
+    store64.py get store.db image out.d64   rebuild an image byte for byte
+    store64.py which store.db sha1          images containing a file
+    store64.py stats store.db
+
+Every 256 byte sector is stored once, keyed by its sha1, and an image is
+kept as the list of its sector hashes.  Each file in an image is hashed
+too, so finding every disk that holds a given file is an index lookup.
+Images are named by the sha1 of their contents; get also accepts the
+path they were added from.
+"""
+import sys, hashlib, sqlite3
+import d64
+
+schema = """
+create table if not exists blobs (
+    hash blob primary key,
+    data blob
+);
+create table if not exists images (
+    hash text primary key,
+    size integer,
+    sectors blob,
+    tail blob
+);
+create table if not exists paths (
+    path text primary key,
+    image text
+);
+create table if not exists files (
+    sha1 text,
+    image text,
+    name text,
+    typ integer
+);
+create index if not exists files_sha1 on files(sha1);
+"""
+
+class Store(object) :
+    def __init__(self, fn) :
+        self.db = sqlite3.connect(fn)
+        self.db.text_factory = str
+        self.db.executescript(schema)
+
+    def close(self) :
+        self.db.commit()
+        self.db.close()
+
+    def fileHashes(self, fn) :
+        """(sha1, name, type) of every file in the image, or nothing if it won't parse."""
+        try :
+            with d64.Disk(fn, mm=True, ro=True) as d :
+                return [(hashlib.sha1(bs).hexdigest(), nm, typ) for nm,bs,typ in d.exportFiles()]
+        except Exception, e :
+            print '%s: not indexing files: %s' % (fn, e)
+            return []
+
+    def add(self, fn) :
+        """Add an image, returning its hash."""
+        dat = file(fn, 'rb').read()
+        ih = hashlib.sha1(dat).hexdigest()
+        self.db.execute("insert or replace into paths values (?, ?)", (fn, ih))
+        if self.db.execute("select 1 from images where hash = ?", (ih,)).fetchone() :
+            return ih
+        n = len(dat) // 256
+        secs = [dat[i*256 : i*256 + 256] for i in xrange(n)]
+        hs = [hashlib.sha1(s).digest() for s in secs]
+        self.db.executemany("insert or ignore into blobs values (?, ?)",
+            ((buffer(h), buffer(s)) for h,s in zip(hs, secs)))
+        self.db.execute("insert into images values (?, ?, ?, ?)",
+            (ih, len(dat), buffer(''.join(hs)), buffer(dat[n*256:])))
+        self.db.executemany("insert into files values (?, ?, ?, ?)",
+            ((fh, ih, nm, typ) for fh,nm,typ in self.fileHashes(fn)))
+        return ih
+
+    def get(self, key) :
+        """Rebuild an image from its hash or original path."""
+        r = self.db.execute("select size, sectors, tail from images where hash = ?", (key,)).fetchone()
+        if r is None :
+            r = self.db.execute("select size, sectors, tail from images i join paths p on p.image = i.hash where p.path = ?", (key,)).fetchone()
+        if r is None :
+            raise d64.Error("no image %r in store" % key)
+        size,sectors,tail = r
+        hs = [str(sectors[i : i+20]) for i in xrange(0, len(sectors), 20)]
+        blobs = {}
+        for h in set(hs) :
+            d, = self.db.execute("select data from blobs where hash = ?", (buffer(h),)).fetchone()
+            blobs[h] = str(d)
+        dat = ''.join(blobs[h] for h in hs) + str(tail)
+        assert len(dat) == size
+        return dat
+
+    def which(self, sha) :
+        """(image hash, path, file name) of every copy of a file."""
+        return self.db.execute("select p.image, p.path, f.name from files f join paths p on f.image = p.image where f.sha1 = ? order by p.path", (sha,)).fetchall()
+
+    def stats(self) :
+        nimg,raw = self.db.execute("select count(*), sum(size) from images").fetchone()
+        nblob, = self.db.execute("select count(*) from blobs").fetchone()
+        nfile,nuniq = self.db.execute("select count(*), count(distinct sha1) from files").fetchone()
+        return nimg, raw or 0, nblob, nfile, nuniq
+
+def main() :
+    args = sys.argv[1:]
+    if len(args) < 2 :
+        print __doc__
+        sys.exit(1)
+    cmd,st = args[0], Store(args[1])
+    try :
+        if cmd == 'add' :
+            for fn in args[2:] :
+                print st.add(fn), fn
+        elif cmd == 'get' and len(args) == 4 :
+            f = file(args[3], 'wb')
+            f.write(st.get(args[2]))
+            f.close()
+        elif cmd == 'which' and len(args) == 3 :
+            for ih,path,nm in st.which(args[2]) :
+                print ih, path, repr(nm)
+        elif cmd == 'stats' :
+            nimg,raw,nblob,nfile,nuniq = st.stats()
+            print '%d images, %d bytes raw, %d unique sectors (%d bytes)' % (nimg, raw, nblob, nblob * 256)
+            print '%d files, %d unique' % (nfile, nuniq)
+        else :
+            print __doc__
+            sys.exit(1)
+    except d64.Error, e :
+        print 'error:', e
+        sys.exit(1)
+    finally :
+        st.close()
+
+if __name__ == '__main__' :
+    main()
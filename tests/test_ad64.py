@@ -0,0 +1,44 @@
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import asm, ad64
+
+def source(n, changed=None) :
+    lines = ['* = $1000']
+    for i in xrange(n) :
+        lines.append('l%d = *' % i)
+        lines.append('    lda $%04x' % (0x2000 + i) if i != changed else '    sta $%04x' % (0x2000 + i))
+        lines.append('    bne l%d' % i)
+    return '\n'.join(lines) + '\n'
+
+class IncrementalTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, 'prog.s')
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def write(self, src) :
+        f = file(self.fn, 'w')
+        f.write(src)
+        f.close()
+
+    def testPass1Reused(self) :
+        self.write(source(1000))
+        stats = {}
+        ad64.assemble(self.fn, stats)
+        self.assertEqual(stats['pass1'], 3001)
+
+        # one line changed, same size: pass 1 runs only that line
+        self.write(source(1000, changed=500))
+        stats = {}
+        r = ad64.assemble(self.fn, stats)
+        self.assertEqual(stats['pass1'], 1)
+        self.assertEqual(r, asm.asm(self.fn, zpg=False))
+
+        stats = {}
+        ad64.assemble(self.fn, stats)
+        self.assertEqual(stats['pass1'], 0)
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,57 @@
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import d64, bulk64
+
+class BulkTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        self.img = os.path.join(self.dir, 'test.d64')
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data) :
+        f = file(os.path.join(self.dir, name), 'wb')
+        f.write(data)
+        f.close()
+        return os.path.join(self.dir, name)
+
+    def testUnknownManifestType(self) :
+        self.write('a.prg', '\x01\x08a')
+        man = self.write('files.txt', '# files\na.prg A prg\na.prg B xyz\n')
+        try :
+            bulk64.readManifest(man)
+        except d64.Error, e :
+            self.assertTrue('line 3' in str(e))
+        else :
+            self.fail("no error for an unknown type")
+
+    def testExportCollisions(self) :
+        d64.newImage(self.img, 'TEST')
+        with d64.Disk(self.img) as d :
+            d.writeFile('A/B', 0x801, 'one')
+            d.writeFile('A?B', 0x801, 'two')
+            d.writeFile('a_b', 0x801, 'three')
+            d.sync()
+        out = os.path.join(self.dir, 'out')
+        bulk64.exportFiles(self.img, out)
+        got = sorted(file(os.path.join(out, fn), 'rb').read()[2:] for fn in os.listdir(out))
+        self.assertEqual(got, ['one', 'three', 'two'])
+
+    def testExportEmptyEntry(self) :
+        d64.newImage(self.img, 'TEST')
+        with d64.Disk(self.img) as d :
+            d.writeFile('GONE', 0x801, '')
+            d.writeFile('KEPT', 0x801, 'kept')
+            e = d.lookup('GONE')
+            e.typ = 0x80    # DEL
+            e.loc = 0,0
+            e.size = 0
+            d.sync()
+        out = os.path.join(self.dir, 'out')
+        bulk64.exportFiles(self.img, out)
+        self.assertEqual(sorted(os.listdir(out)), ['GONE.del', 'KEPT.prg'])
+        self.assertEqual(file(os.path.join(out, 'GONE.del'), 'rb').read(), '')
+
+if __name__ == '__main__' :
+    unittest.main()
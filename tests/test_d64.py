@@ -0,0 +1,151 @@
+import os, sys, shutil, tempfile, subprocess, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import d64, g64
+
+class ReadOnlyTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, 'ro.d64')
+        d64.newImage(self.fn, 'READONLY', 'RO')
+        with d64.Disk(self.fn) as d :
+            d.writeFile('HELLO', 0x801, 'hello')
+            d.sync()
+        self.immutable = False
+        os.chmod(self.fn, 0444)
+        if self.writable() :
+            # root ignores the mode bits
+            self.immutable = subprocess.call(['chattr', '+i', self.fn], stderr=file(os.devnull, 'w')) == 0
+        if self.writable() :
+            self.skipTest("can't make a read-only file here")
+
+    def tearDown(self) :
+        if self.immutable :
+            subprocess.call(['chattr', '-i', self.fn])
+        shutil.rmtree(self.dir)
+
+    def writable(self) :
+        try :
+            file(self.fn, 'r+b').close()
+            return True
+        except IOError :
+            return False
+
+    def testStat(self) :
+        fmt,name,did,free = d64.stat(self.fn)
+        self.assertEqual((fmt, name, did), (d64.d64Format, 'READONLY', 'RO'))
+
+    def testReadOnlyDisk(self) :
+        for mm in (False, True) :
+            with d64.Disk(self.fn, mm=mm, ro=True) as d :
+                self.assertEqual(d.readFile('HELLO')[1], 'hello')
+                self.assertRaises(d64.Error, d.img.writeSector, 1, 0, '\0' * 256)
+
+    def testG64Encode(self) :
+        with d64.Disk(self.fn, ro=True) as d :
+            g = g64.fromDisk(d, g64.errorInfo(d))
+        self.assertEqual(len(g.tracks), 35)
+
+class AllocTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def testFastAllocDefaultInterleave(self) :
+        fn = os.path.join(self.dir, 'fast.d64')
+        d64.newImage(fn, 'FAST')
+        data = ''.join(chr(i & 0xff) for i in xrange(2000))
+        with d64.Disk(fn, alloc=d64.FastAlloc(interleave=None)) as d :
+            d.writeFile('DATA', 0x801, data)
+            d.sync()
+        with d64.Disk(fn, ro=True) as d :
+            self.assertEqual(d.readFile('DATA')[1], data)
+            secs = [(t, s) for t,s,bs in d.fileSectors(d.lookup('DATA').loc)]
+        # the format's own interleave, 10 for a 1541
+        self.assertEqual(secs[1][1] - secs[0][1], d64.d64Format.interleave)
+
+class ModeTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def mode(self, fn) :
+        return os.stat(fn).st_mode & 0777
+
+    def testReplaceImage(self) :
+        fn = os.path.join(self.dir, 'whole.d64')
+        d64.newImage(fn, 'WHOLE')
+        os.chmod(fn, 0640)
+        with d64.Disk(fn) as d :
+            d.begin()
+            d.writeFile('HELLO', 0x801, 'hello')
+            d.commit(whole=True)
+        self.assertEqual(self.mode(fn), 0640)
+
+    def testPacked(self) :
+        src = os.path.join(self.dir, 'src.d64')
+        fn = os.path.join(self.dir, 'packed.d64z')
+        d64.newImage(src, 'PACKED')
+        d64.packImage(src, fn)
+        os.chmod(fn, 0640)
+        with d64.Disk(fn) as d :
+            d.writeFile('HELLO', 0x801, 'hello')
+            d.sync()
+        self.assertEqual(self.mode(fn), 0640)
+        with d64.Disk(fn, ro=True) as d :
+            self.assertEqual(d.readFile('HELLO')[1], 'hello')
+
+class TransactionTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, 'txn.d64')
+        d64.newImage(self.fn, 'TXN')
+        with d64.Disk(self.fn) as d :
+            d.createRel('RECS', 20).setRecord(0, 'before')
+            d.sync()
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def testRollbackStaged(self) :
+        with d64.Disk(self.fn) as d :
+            d.openRel('RECS').setRecord(0, 'staged')
+            d.begin()
+            d.rollback()
+        with d64.Disk(self.fn) as d :
+            self.assertEqual(d.openRel('RECS').record(0).rstrip('\0'), 'before')
+
+    def testCommitStaged(self) :
+        with d64.Disk(self.fn) as d :
+            d.openRel('RECS').setRecord(0, 'staged')
+            d.begin()
+            d.commit()
+        with d64.Disk(self.fn) as d :
+            self.assertEqual(d.openRel('RECS').record(0).rstrip('\0'), 'staged')
+
+class ExportTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def testEntryWithoutChain(self) :
+        fn = os.path.join(self.dir, 'del.d64')
+        d64.newImage(fn, 'DEL')
+        with d64.Disk(fn) as d :
+            d.writeFile('EMPTY', 0x801, '')
+            d.writeFile('HELLO', 0x801, 'hello')
+            e = d.lookup('EMPTY')
+            e.typ = 0x80    # DEL
+            e.loc = 0,0
+            e.size = 0
+            d.sync()
+        with d64.Disk(fn, ro=True) as d :
+            self.assertEqual(list(d.exportFiles()), [('EMPTY', '', 0x80), ('HELLO', '\x01\x08hello', 0x82)])
+
+if __name__ == '__main__' :
+    unittest.main()
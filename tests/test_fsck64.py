@@ -0,0 +1,38 @@
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import d64, fsck64
+
+class D81Test(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, 'test.d81')
+        d64.newImage(self.fn, 'TEST', '81', d64.d81Format)
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def test1581Layout(self) :
+        # the 1581 only uses 40/0-3 on track 40: $24 free, then $f0 $ff $ff $ff $ff
+        fmt = d64.d81Format
+        f = file(self.fn, 'rb')
+        f.seek(fmt.offset(40, 1) * 256 + 0x10 + 39 * 6)
+        self.assertEqual(f.read(6), '\x24\xf0\xff\xff\xff\xff')
+        f.close()
+
+    def testFsckLeavesBAM(self) :
+        before = file(self.fn, 'rb').read()
+        fn,problems,fixed = fsck64.checkImage((self.fn, True))
+        self.assertEqual(problems, [])
+        self.assertFalse(fixed)
+        self.assertEqual(file(self.fn, 'rb').read(), before)
+
+    def testDirectoryGrows(self) :
+        with d64.Disk(self.fn) as d :
+            for n in xrange(40) :
+                d.writeFile('F%d' % n, 0x801, 'x')
+            d.sync()
+        fn,problems,fixed = fsck64.checkImage((self.fn, False))
+        self.assertEqual(problems, [])
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,35 @@
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import d64, g64
+
+class ErrorInfoTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, 'errs.d64')
+        d64.newImage(self.fn, 'ERRORS')
+        self.errs = bytearray([g64.errOK]) * d64.d64Format.total
+        self.errs[d64.d64Format.offset(1, 3)] = 0x05    # data checksum error
+        f = file(self.fn, 'ab')
+        f.write(self.errs)
+        f.close()
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def encode(self, fn, mm=False) :
+        with d64.Disk(fn, mm=mm, ro=True) as d :
+            errs = g64.errorInfo(d)
+            return errs, g64.fromDisk(d, errs).toBytes()
+
+    def testPacked(self) :
+        packed = os.path.join(self.dir, 'errs.d64z')
+        d64.packImage(self.fn, packed)
+        want = self.encode(self.fn)
+        self.assertEqual(want[0], self.errs)
+        self.assertEqual(self.encode(self.fn, mm=True), want)
+        self.assertEqual(self.encode(packed), want)
+        g = g64.G64().fromBytes(want[1])
+        self.assertEqual(g64.toImage(g, os.path.join(self.dir, 'back.d64')), 1)
+
+if __name__ == '__main__' :
+    unittest.main()
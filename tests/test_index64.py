@@ -0,0 +1,28 @@
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import d64, index64
+
+class ScanTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, 'test.d64')
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def testEntryWithoutChain(self) :
+        d64.newImage(self.fn, 'TEST')
+        with d64.Disk(self.fn) as d :
+            d.writeFile('FIRST', 0x801, 'one')
+            d.writeFile('AFTER', 0x801, 'two')
+            e = d.dir[0]
+            e.typ = 0x80    # DEL
+            e.loc = 0,0
+            e.size = 0
+            d.sync()
+        path,mtime,size,name,did,free,ents,err = index64.scanImage((self.fn, 0, 0))
+        self.assertEqual(err, None)
+        self.assertEqual([(nm, n, sha is None) for slot,nm,typ,blocks,n,sha in ents], [('FIRST', 0, True), ('AFTER', 5, False)])
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,54 @@
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import asm, ld64
+
+main = """* = $1000
+start = *
+    ldx #3
+_loop = *
+    dex
+    bne _loop
+    jsr sub
+    jmp _loop
+"""
+sub = """sub = *
+    ldy #2
+_loop = *
+    dey
+    bne _loop
+    rts
+"""
+
+class LinkTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self) :
+        shutil.rmtree(self.dir)
+
+    def write(self, name, src) :
+        fn = os.path.join(self.dir, name)
+        f = file(fn, 'w')
+        f.write(src)
+        f.close()
+        return fn
+
+    def link(self, *srcs) :
+        fns = [self.write('m%d.s' % n, src) for n,src in enumerate(srcs)]
+        return ld64.link([ld64.build(fn)[0] for fn in fns], fns)
+
+    def testLocalLabels(self) :
+        (start,bs),syms = self.link(main, sub)
+        self.assertEqual(syms, {'start': 0x1000, 'sub': 0x100b})
+        self.assertEqual(start, 0x1000)
+        self.assertEqual(bs, [0xa2, 3, 0xca, 0xd0, 0xfd, 0x20, 0x0b, 0x10, 0x4c, 0x02, 0x10,
+                              0xa0, 2, 0x88, 0xd0, 0xfd, 0x60])
+
+    def testGlobalTwice(self) :
+        self.assertRaises(ld64.LinkError, self.link, main, sub, sub)
+
+    def testLocalNotShared(self) :
+        self.assertRaises(ld64.LinkError, self.link, main, sub, "    jmp _loop\n")
+
+if __name__ == '__main__' :
+    unittest.main()
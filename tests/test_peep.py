@@ -0,0 +1,21 @@
+import os, sys, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import asm, peep
+
+def storeLoad(addr) :
+    return asm.parseSource('* = $1000\n    sta $%04x\n    lda $%04x\n    lda #0\n    rts\n' % (addr, addr))
+
+class StoreLoadTest(unittest.TestCase) :
+    def ops(self, p) :
+        return [l.op for l in p if l.typ == 'op']
+
+    def testRam(self) :
+        self.assertEqual(self.ops(peep.optimise(storeLoad(0xc000))), ['sta', 'lda', 'rts'])
+
+    def testUnsafe(self) :
+        # processor port, RAM under BASIC, I/O and RAM under the KERNAL
+        for addr in (0x0001, 0xa000, 0xd020, 0xfffe) :
+            self.assertEqual(self.ops(peep.optimise(storeLoad(addr))), ['sta', 'lda', 'lda', 'rts'])
+
+if __name__ == '__main__' :
+    unittest.main()
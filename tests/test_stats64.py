@@ -0,0 +1,23 @@
+import os, sys, unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import d64, stats64
+
+class EntropyTest(unittest.TestCase) :
+    def testTrackEntropyChunks(self) :
+        fmt = d64.d64Format
+        rnd = np.random.RandomState(64)
+        imgs = rnd.randint(0, 256, (5, fmt.total, 256)).astype(np.uint8)
+        imgs[1, :, :] = 0
+        imgs[2, :, ::2] = 7
+        offs,trackOf,secOf = stats64.layout(fmt)
+        want = np.empty((5, fmt.tracks))
+        for n in xrange(5) :
+            for t in xrange(fmt.tracks) :
+                want[n, t] = stats64.entropy(np.bincount(imgs[n, trackOf == t + 1].ravel(), minlength=256))
+        # chunks that don't divide the batch evenly, and the whole batch at once
+        for chunk in (2, 64) :
+            self.assertTrue(np.allclose(stats64.trackEntropy(imgs, fmt, chunk), want))
+
+if __name__ == '__main__' :
+    unittest.main()
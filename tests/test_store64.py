@@ -0,0 +1,32 @@
+import os, sys, shutil, hashlib, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import d64, store64
+
+class StoreTest(unittest.TestCase) :
+    def setUp(self) :
+        self.dir = tempfile.mkdtemp()
+        self.img = os.path.join(self.dir, 'test.d64')
+        self.st = store64.Store(os.path.join(self.dir, 'store.db'))
+
+    def tearDown(self) :
+        self.st.close()
+        shutil.rmtree(self.dir)
+
+    def testEmptyEntry(self) :
+        d64.newImage(self.img, 'TEST')
+        with d64.Disk(self.img) as d :
+            d.writeFile('GONE', 0x801, '')
+            d.writeFile('KEPT', 0x801, 'kept')
+            e = d.lookup('GONE')
+            e.typ = 0x80    # DEL
+            e.loc = 0,0
+            e.size = 0
+            d.sync()
+        ih = self.st.add(self.img)
+        self.assertEqual(self.st.get(ih), file(self.img, 'rb').read())
+        kept = hashlib.sha1('\x01\x08kept').hexdigest()
+        self.assertEqual(self.st.which(kept), [(ih, self.img, 'KEPT')])
+        self.assertEqual(self.st.which(hashlib.sha1('').hexdigest()), [(ih, self.img, 'GONE')])
+
+if __name__ == '__main__' :
+    unittest.main()